@@ -0,0 +1,188 @@
+# File: services/chat-services/app/admission.py
+
+import math
+import time
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+# Upper bounds of the histogram buckets; the last bucket counts everything above.
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+WAIT_MS_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+# Weight of the newest sample in the average request duration used for Retry-After.
+DURATION_EWMA_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be queued; `retry_after` is a hint in whole seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class Histogram:
+    """Fixed-bucket counts, reported as {"le_<bound>": n, ..., "inf": n}."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def stats(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {"buckets": buckets, "count": self.total,
+                "mean": round(self.sum / self.total, 1) if self.total else None}
+
+
+class Ticket:
+    """A request's place in the admission queue; `granted` is set once it may run."""
+
+    def __init__(self, controller, session_id):
+        self.controller = controller
+        self.session_id = session_id
+        self.granted = asyncio.Event()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.done = False
+
+    @property
+    def position(self):
+        """Number of requests that will be admitted before this one; 0 once admitted."""
+        return self.controller.position(self)
+
+    async def wait(self):
+        await self.granted.wait()
+
+    def release(self):
+        """Frees the slot (or the queue entry, if never admitted). Safe to call more than once."""
+        if not self.done:
+            self.done = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    Limits how many LLM requests run at once and queues the rest fairly.
+
+    Capacity is `max_per_backend` times the number of available backends
+    (at least one slot), as last reported through `set_backend_count`.
+    Waiting requests are grouped by session and admitted round-robin across
+    sessions, so a session firing many requests only ever takes its turn.
+    At most `max_queue` requests wait in total and `max_per_session` per
+    session; beyond that `enqueue` raises Overloaded. All state is per
+    worker and only touched from the event loop.
+    """
+
+    def __init__(self, max_per_backend=4, max_queue=64, max_per_session=2):
+        self.max_per_backend = max_per_backend
+        self.max_queue = max_queue
+        self.max_per_session = max_per_session
+        self.backend_count = 1
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        # session_id -> deque of waiting tickets, in the order sessions take turns.
+        self._waiting = OrderedDict()
+        self._duration = None
+        self.queue_depth = Histogram(QUEUE_DEPTH_BUCKETS)
+        self.wait_ms = Histogram(WAIT_MS_BUCKETS)
+
+    @property
+    def capacity(self):
+        return max(1, self.max_per_backend * self.backend_count)
+
+    def set_backend_count(self, count):
+        if count != self.backend_count:
+            self.backend_count = count
+            self._dispatch()
+
+    def retry_after(self):
+        """Rough seconds until a slot frees up for a request joining the back of the queue."""
+        duration = self._duration if self._duration is not None else 10.0
+        return max(1, math.ceil((self.queued + 1) / self.capacity * duration))
+
+    def enqueue(self, session_id):
+        """Returns a Ticket for the request, admitted immediately if there is room."""
+        self.queue_depth.observe(self.queued)
+        if self.active >= self.capacity or self.queued:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded("Too many requests are waiting.", self.retry_after())
+            if len(self._waiting.get(session_id, ())) >= self.max_per_session:
+                self.rejected += 1
+                raise Overloaded("This session already has requests waiting.", self.retry_after())
+        ticket = Ticket(self, session_id)
+        self._waiting.setdefault(session_id, deque()).append(ticket)
+        self.queued += 1
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket):
+        if ticket.granted.is_set() or ticket.done:
+            return 0
+        # Walk the round-robin order the dispatcher will follow.
+        queues = [list(q) for q in self._waiting.values()]
+        position = 0
+        for depth in range(max(len(q) for q in queues)):
+            for q in queues:
+                if depth < len(q):
+                    position += 1
+                    if q[depth] is ticket:
+                        return position
+        return 0
+
+    def _dispatch(self):
+        while self._waiting and self.active < self.capacity:
+            session_id, waiting = next(iter(self._waiting.items()))
+            ticket = waiting.popleft()
+            if waiting:
+                self._waiting.move_to_end(session_id)
+            else:
+                del self._waiting[session_id]
+            self.queued -= 1
+            self.active += 1
+            self.admitted += 1
+            ticket.started_at = time.monotonic()
+            self.wait_ms.observe((ticket.started_at - ticket.enqueued_at) * 1000)
+            ticket.granted.set()
+
+    def _release(self, ticket):
+        if ticket.granted.is_set():
+            self.active -= 1
+            duration = time.monotonic() - ticket.started_at
+            self._duration = duration if self._duration is None else \
+                self._duration + DURATION_EWMA_ALPHA * (duration - self._duration)
+        else:
+            waiting = self._waiting.get(ticket.session_id)
+            if waiting and ticket in waiting:
+                waiting.remove(ticket)
+                self.queued -= 1
+                if not waiting:
+                    del self._waiting[ticket.session_id]
+        self._dispatch()
+
+    def session_position(self, session_id):
+        """Queue position of the session's next waiting request, or None if it has none."""
+        waiting = self._waiting.get(session_id)
+        return self.position(waiting[0]) if waiting else None
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_duration_ms": round(self._duration * 1000, 1) if self._duration is not None else None,
+            "queue_depth": self.queue_depth.stats(),
+            "wait_ms": self.wait_ms.stats(),
+        }
@@ -0,0 +1,184 @@
+# File: services/chat-services/app/backends.py
+
+import time
+import asyncio
+import itertools
+import httpx
+from contextlib import contextmanager
+
+# Weight of the newest sample in a backend's latency moving averages.
+LATENCY_EWMA_ALPHA = 0.2
+
+
+def parse_backend_urls(value):
+    """The lm_studio_url setting may list several backends separated by commas or whitespace."""
+    if not value:
+        return []
+    urls = []
+    for url in str(value).replace(",", " ").split():
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+def api_url(chat_url, endpoint):
+    """Another OpenAI-compatible endpoint (e.g. "models", "embeddings") on the host of a chat completions URL."""
+    base = chat_url.rstrip("/")
+    if base.endswith("/chat/completions"):
+        base = base[:-len("/chat/completions")]
+    return f"{base}/{endpoint}"
+
+
+def is_backend_failure(error):
+    """
+    Whether an httpx error counts against the backend (for failover and its circuit
+    breaker): connection problems, timeouts and 5xx answers do. A 4xx answer means the
+    request itself was rejected (e.g. its context is too long), as any backend would.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return True
+
+
+class Backend:
+    """One OpenAI-compatible LLM host and the state the pool tracks for it."""
+
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        # Circuit breaker: None while closed, otherwise the time it may be retried.
+        self.open_until = None
+        # Set while the single trial request of a half-open circuit is running.
+        self.trial_running = False
+        self.ttft_ms = None
+        self.duration_ms = None
+        self.last_probe_ok = None
+        self.last_error = None
+
+    def state(self, now=None):
+        if self.open_until is None:
+            return "closed"
+        return "open" if (now or time.monotonic()) < self.open_until else "half_open"
+
+    def available(self, now):
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self.trial_running)
+
+    def stats(self):
+        def rounded(value):
+            return round(value, 1) if value is not None else None
+        return {
+            "url": self.url,
+            "state": self.state(),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_failures": self.consecutive_failures,
+            "ttft_ms": rounded(self.ttft_ms),
+            "duration_ms": rounded(self.duration_ms),
+            "last_probe_ok": self.last_probe_ok,
+            "last_error": self.last_error,
+        }
+
+
+def _ewma(current, sample):
+    return sample if current is None else current + LATENCY_EWMA_ALPHA * (sample - current)
+
+
+class BackendPool:
+    """
+    Routes LLM requests across a set of backends.
+
+    Each request goes to the available backend with the fewest in-flight
+    requests, ties broken by the lower time-to-first-token average and then in
+    rotation. After `failure_threshold` consecutive failures (requests or health
+    probes) a backend's circuit opens for `open_seconds`; after that a single
+    trial request is let through, and its outcome closes or re-opens the circuit.
+    All state lives in this process and is only touched from the event loop.
+    """
+
+    def __init__(self, failure_threshold=3, open_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._backends = {}
+        self._rotation = itertools.count()
+
+    def update(self, urls):
+        """Syncs the pool with the configured URLs, keeping the state of backends that remain."""
+        if list(self._backends) == urls:
+            return
+        self._backends = {url: self._backends.get(url) or Backend(url) for url in urls}
+
+    @property
+    def backends(self):
+        return list(self._backends.values())
+
+    def available_count(self):
+        """Number of backends a request could be sent to right now (see Backend.available)."""
+        now = time.monotonic()
+        return sum(1 for b in self._backends.values() if b.available(now))
+
+    def pick(self, exclude=()):
+        """Returns the backend the next request should use, or None if none is available."""
+        now = time.monotonic()
+        candidates = [b for b in self._backends.values() if b.url not in exclude and b.available(now)]
+        if not candidates:
+            return None
+        turn = next(self._rotation)
+        order = {b.url: (i - turn) % len(candidates) for i, b in enumerate(candidates)}
+        return min(candidates, key=lambda b: (
+            b.in_flight, b.ttft_ms if b.ttft_ms is not None else 0.0, order[b.url]))
+
+    @contextmanager
+    def lease(self, backend):
+        """Counts a request against `backend` while it runs."""
+        if backend.state() == "half_open":
+            backend.trial_running = True
+        backend.in_flight += 1
+        backend.requests += 1
+        try:
+            yield backend
+        finally:
+            backend.in_flight -= 1
+            backend.trial_running = False
+
+    def record_first_token(self, backend, seconds):
+        backend.ttft_ms = _ewma(backend.ttft_ms, seconds * 1000)
+
+    def record_success(self, backend, seconds=None):
+        if seconds is not None:
+            backend.duration_ms = _ewma(backend.duration_ms, seconds * 1000)
+        backend.consecutive_failures = 0
+        backend.open_until = None
+
+    def record_failure(self, backend, error):
+        backend.errors += 1
+        backend.consecutive_failures += 1
+        backend.last_error = str(error) or type(error).__name__
+        if backend.state() == "half_open" or backend.consecutive_failures >= self.failure_threshold:
+            backend.open_until = time.monotonic() + self.open_seconds
+
+    async def probe(self, http_client, timeout):
+        """Health-checks every backend concurrently; a failed probe counts as a failure (a 4xx answer does not)."""
+        async def check(backend):
+            try:
+                response = await http_client.get(api_url(backend.url, "models"), timeout=timeout)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                if is_backend_failure(e):
+                    backend.last_probe_ok = False
+                    self.record_failure(backend, e)
+                    return
+                # A 4xx answer (e.g. a host without /models) still shows the backend is up.
+                backend.last_error = str(e)
+            backend.last_probe_ok = True
+            if backend.state() != "closed" or backend.consecutive_failures:
+                self.record_success(backend)
+
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
@@ -0,0 +1,66 @@
+# File: services/chat-services/app/compaction.py
+
+from context import message_tokens, latest_summary, live_turns
+
+SUMMARY_MAX_TOKENS = 512
+SUMMARIZER_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the existing summary (if any) with the new messages into one concise summary. "
+    "Keep names, facts, decisions, open questions and any instructions the user gave. "
+    "Reply with the summary only."
+)
+
+
+def plan_compaction(history, context_limit, trigger_ratio, keep_ratio):
+    """
+    Decides whether a session needs compacting.
+
+    Returns (previous_summary, aged_out_messages) when the uncompacted history is
+    above trigger_ratio * context_limit, where the aged-out messages are the oldest
+    turns not yet summarized, leaving roughly keep_ratio * context_limit tokens of
+    recent turns verbatim. Returns None when nothing needs to be done.
+    """
+    summary = latest_summary(history)
+    turns = live_turns(history, summary)
+    total = sum(message_tokens(m) for m in turns) + (message_tokens(summary) if summary else 0)
+    if total <= trigger_ratio * context_limit:
+        return None
+
+    keep_budget = keep_ratio * context_limit
+    cut = len(turns)
+    kept = 0
+    for i in range(len(turns) - 1, -1, -1):
+        kept += message_tokens(turns[i])
+        if kept > keep_budget:
+            break
+        cut = i
+    # Never leave the verbatim window starting with an assistant reply.
+    while cut < len(turns) and turns[cut]["role"] == "assistant":
+        cut += 1
+    # Always leave the latest user message (and the replies to it) verbatim, so the
+    # context still ends with a question if its reply is regenerated.
+    user_turns = [i for i, m in enumerate(turns) if m["role"] == "user"]
+    cut = min(cut, user_turns[-1] if user_turns else len(turns) - 1)
+
+    aged = turns[:cut]
+    if not aged:
+        return None
+    return summary, aged
+
+
+async def summarize(http_client, lm_studio_url, previous_summary, aged):
+    """Asks the LLM to fold the aged-out messages into the running summary."""
+    parts = []
+    if previous_summary:
+        parts.append(f"Existing summary:\n{previous_summary['content']}\n")
+    parts.append("New messages:")
+    parts.extend(f"{m['role']}: {m['content']}" for m in aged)
+
+    response = await http_client.post(lm_studio_url, json={
+        "messages": [{"role": "system", "content": SUMMARIZER_PROMPT},
+                     {"role": "user", "content": "\n".join(parts)}],
+        "max_tokens": SUMMARY_MAX_TOKENS,
+        "stream": False,
+    })
+    response.raise_for_status()
+    return response.json()['choices'][0]['message']['content'].strip()
@@ -0,0 +1,78 @@
+# File: services/chat-services/app/context.py
+
+# Tokens added per message for the chat template's role markers and separators.
+MESSAGE_OVERHEAD_TOKENS = 4
+# core-service stores about 4 characters per token, close for English prose but
+# well short for code (nearer 3) and CJK text (about 1 per character). The UTF-8
+# length over 3 covers both, as CJK characters take 3 bytes; the larger estimate is used.
+UTF8_BYTES_PER_TOKEN = 3
+# Introduces a compaction summary when it is sent to the LLM as a system message.
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def message_tokens(message):
+    """Token cost of one history message: the count core-service stored at insert, or more (see above)."""
+    by_bytes = -(-len((message.get("content") or "").encode("utf-8")) // UTF8_BYTES_PER_TOKEN)
+    return max(message.get("tokens", 0), by_bytes) + MESSAGE_OVERHEAD_TOKENS
+
+
+def to_setting_int(value, default):
+    """Settings come back from core-service as strings; parse them defensively."""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def latest_summary(history):
+    """Returns the newest compaction summary row in the history, or None."""
+    for message in reversed(history):
+        if message.get("role") == "summary":
+            return message
+    return None
+
+
+def live_turns(history, summary=None):
+    """User/assistant messages not already covered by `summary`."""
+    covered_to = summary["summary_to_id"] if summary else None
+    return [m for m in history if m.get("role") in ("user", "assistant")
+            and (covered_to is None or m.get("id", 0) > covered_to)]
+
+
+def build_context(history, context_limit, max_tokens=-1):
+    """
+    Assembles the messages to send to the LLM within a token budget.
+
+    The system prompt and the latest compaction summary (if any) are always kept,
+    followed by the newest messages the summary does not cover that fit in
+    `context_limit` minus the tokens reserved for the reply (`max_tokens`, when
+    positive). The newest message is always sent even if it alone exceeds the
+    budget, and the kept window never starts with an assistant reply.
+    """
+    if not history:
+        return []
+
+    system = [history[0]] if history[0].get("role") == "system" else []
+    summary = latest_summary(history)
+    turns = live_turns(history, summary)
+    if summary:
+        system.append({"role": "system", "content": SUMMARY_PREFIX + summary["content"],
+                       "tokens": summary.get("tokens", 0)})
+
+    budget = context_limit - sum(message_tokens(m) for m in system)
+    if max_tokens and max_tokens > 0:
+        budget -= max_tokens
+
+    start = len(turns)
+    for i in range(len(turns) - 1, -1, -1):
+        cost = message_tokens(turns[i])
+        if cost > budget and start < len(turns):
+            break
+        budget -= cost
+        start = i
+
+    kept = turns[start:]
+    while len(kept) > 1 and kept[0].get("role") == "assistant":
+        kept = kept[1:]
+
+    return [{"role": m["role"], "content": m["content"]} for m in system + kept]
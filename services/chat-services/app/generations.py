@@ -0,0 +1,130 @@
+# File: services/chat-services/app/generations.py
+
+import time
+import uuid
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Generation:
+    """
+    One LLM reply being produced, decoupled from the client connections reading it.
+
+    The upstream stream writes the response bytes with `append`; any number of
+    readers follow along with `read(offset)`, so a client that lost its
+    connection can reattach and continue from the last byte it received.
+    """
+
+    def __init__(self, session_id):
+        self.stream_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.data = bytearray()
+        self.done = False
+        self.readers = 0
+        self.detached_at = time.monotonic()
+        self.finished_at = None
+        # Set once a checkpoint of this reply may exist in core-service.
+        self.checkpointed = False
+        self.task = None
+        self.finished = asyncio.Event()
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def append(self, chunk):
+        self.data += chunk
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self.finished_at = time.monotonic()
+        self.finished.set()
+        self._notify()
+
+    async def read(self, offset=0):
+        """Yields the response from byte `offset` on, following new bytes until the reply is done."""
+        self.readers += 1
+        try:
+            while True:
+                if offset < len(self.data):
+                    chunk = bytes(self.data[offset:])
+                    offset += len(chunk)
+                    yield chunk
+                    continue
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.readers -= 1
+            if not self.readers:
+                self.detached_at = time.monotonic()
+
+
+class GenerationRegistry:
+    """
+    Running and recently finished generations of this worker, by stream id.
+
+    A generation nobody has been reading for `abandon_seconds` is cancelled, so a
+    client that never comes back does not keep an LLM busy. Finished generations
+    stay resumable for `retain_seconds`.
+    """
+
+    def __init__(self, abandon_seconds=30.0, retain_seconds=60.0):
+        self.abandon_seconds = abandon_seconds
+        self.retain_seconds = retain_seconds
+        self._generations = {}
+        self._reaper = None
+
+    def start(self, session_id, run):
+        """Starts `run(generation)` as a background task and returns the generation."""
+        generation = Generation(session_id)
+        self._generations[generation.stream_id] = generation
+        generation.task = asyncio.create_task(run(generation))
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+        return generation
+
+    def get(self, stream_id):
+        return self._generations.get(stream_id)
+
+    async def stop(self, generation):
+        """Cancels a generation that is still streaming and waits until it has wound down."""
+        if generation.task and not generation.task.done():
+            if not generation.done:
+                generation.task.cancel()
+            await asyncio.gather(generation.task, return_exceptions=True)
+
+    async def stop_session(self, session_id):
+        """Stops the session's generations, e.g. before its next message, once their replies are queued."""
+        for generation in list(self._generations.values()):
+            if generation.session_id == session_id:
+                await self.stop(generation)
+
+    async def stop_all(self):
+        for generation in list(self._generations.values()):
+            await self.stop(generation)
+        if self._reaper:
+            self._reaper.cancel()
+
+    async def _reap(self):
+        interval = max(1.0, min(self.abandon_seconds, self.retain_seconds) / 4)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for stream_id, generation in list(self._generations.items()):
+                if generation.readers:
+                    continue
+                if generation.done:
+                    if now - max(generation.detached_at, generation.finished_at) >= self.retain_seconds:
+                        del self._generations[stream_id]
+                elif now - generation.detached_at >= self.abandon_seconds:
+                    logger.info(f"Stopping generation {stream_id}: no client for {self.abandon_seconds:.0f} s.")
+                    generation.task.cancel()
+
+    def stats(self):
+        running = sum(1 for generation in self._generations.values() if not generation.done)
+        return {"running": running, "retained": len(self._generations) - running}
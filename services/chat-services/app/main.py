@@ -1,134 +1,619 @@
 import os
-import requests
-import json
-from flask import Flask, request, Response, jsonify, stream_with_context
-from flask_cors import CORS
+import time
+import uuid
+import asyncio
+import logging
+import httpx
+from collections import OrderedDict
+from quart import Quart, request, Response, jsonify
+from quart_cors import cors
+from qdrant_client import AsyncQdrantClient
+from context import build_context, to_setting_int
+from compaction import plan_compaction, summarize
+from streaming import coalesce_deltas
+from backends import BackendPool, api_url, is_backend_failure, parse_backend_urls
+from admission import AdmissionController, Overloaded
+from persistence import PersistenceQueue
+from titles import generate_title
+from semantic_cache import SemanticCache, embed, prompt_hash
+from generations import GenerationRegistry
+from wire import decode, encode, wire_mimetype
 
-app = Flask(__name__)
-CORS(app)
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Quart(__name__)
+# LLM replies can stream for longer than Quart's default 60 s response timeout.
+app.config["RESPONSE_TIMEOUT"] = None
+app = cors(app)
 
 # Get Core Service URL from environment variable
 CORE_SERVICE_URL = os.environ.get("CORE_SERVICE_URL", "http://core-service:8000")
 API_PREFIX = "/api/chat"
+# Encoding of bodies exchanged with core-service's internal routes: "json" (orjson on
+# both ends) or "msgpack". The two perform alike; JSON stays readable with curl.
+CORE_WIRE_FORMAT = os.environ.get("CORE_WIRE_FORMAT", "json")
+# Number of session histories each worker keeps for incremental sync with core-service.
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", "256"))
+# Used when core-service has no context_limit setting.
+DEFAULT_CONTEXT_LIMIT = 8000
+# Optional background compaction: once a session's uncompacted history passes
+# COMPACTION_TRIGGER_RATIO * context_limit tokens, its oldest turns are summarized,
+# leaving about COMPACTION_KEEP_RATIO * context_limit tokens of recent turns verbatim.
+COMPACTION_ENABLED = os.environ.get("COMPACTION_ENABLED", "0") == "1"
+COMPACTION_TRIGGER_RATIO = float(os.environ.get("COMPACTION_TRIGGER_RATIO", "0.75"))
+COMPACTION_KEEP_RATIO = float(os.environ.get("COMPACTION_KEEP_RATIO", "0.4"))
+# Keep-alive connection pool shared by every request in this process.
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "1000"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "100"))
+# Reply tokens are written to the client in batches: a flush happens once this many
+# bytes are buffered or this many milliseconds have passed. The first token is never held.
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "256"))
+STREAM_FLUSH_INTERVAL_MS = int(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "40"))
+# Replies are generated independently of the client connection: the text so far is
+# checkpointed to core-service every STREAM_CHECKPOINT_INTERVAL seconds, a generation
+# with no client for STREAM_ABANDON_SECONDS is stopped, and a finished one stays
+# resumable for STREAM_RETAIN_SECONDS.
+STREAM_CHECKPOINT_INTERVAL = float(os.environ.get("STREAM_CHECKPOINT_INTERVAL", "2"))
+STREAM_ABANDON_SECONDS = float(os.environ.get("STREAM_ABANDON_SECONDS", "30"))
+STREAM_RETAIN_SECONDS = float(os.environ.get("STREAM_RETAIN_SECONDS", "60"))
+# LLM backends: LLM_BACKENDS (comma-separated chat completion URLs) overrides the
+# lm_studio_url setting, which may itself list several URLs.
+LLM_BACKENDS = os.environ.get("LLM_BACKENDS", "")
+LLM_HEALTH_INTERVAL = float(os.environ.get("LLM_HEALTH_INTERVAL", "10"))
+LLM_HEALTH_TIMEOUT = float(os.environ.get("LLM_HEALTH_TIMEOUT", "2"))
+LLM_CIRCUIT_FAILURES = int(os.environ.get("LLM_CIRCUIT_FAILURES", "3"))
+LLM_CIRCUIT_OPEN_SECONDS = float(os.environ.get("LLM_CIRCUIT_OPEN_SECONDS", "30"))
+# Admission control: at most ADMISSION_MAX_PER_BACKEND streams per backend run at once;
+# the rest wait, up to ADMISSION_MAX_QUEUE in total and ADMISSION_MAX_PER_SESSION per session.
+ADMISSION_MAX_PER_BACKEND = int(os.environ.get("ADMISSION_MAX_PER_BACKEND", "4"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_PER_SESSION = int(os.environ.get("ADMISSION_MAX_PER_SESSION", "2"))
+# Replies are stored in the background: PERSIST_WORKERS tasks work through a queue of
+# at most PERSIST_QUEUE_SIZE jobs, each tried up to PERSIST_MAX_ATTEMPTS times. On
+# shutdown the queue gets PERSIST_DRAIN_TIMEOUT seconds to empty, which together with
+# Hypercorn's 3 s graceful timeout fits in Docker's default 10 s stop period.
+PERSIST_QUEUE_SIZE = int(os.environ.get("PERSIST_QUEUE_SIZE", "1000"))
+PERSIST_WORKERS = int(os.environ.get("PERSIST_WORKERS", "2"))
+PERSIST_MAX_ATTEMPTS = int(os.environ.get("PERSIST_MAX_ATTEMPTS", "5"))
+PERSIST_DRAIN_TIMEOUT = float(os.environ.get("PERSIST_DRAIN_TIMEOUT", "5"))
+# Optionally replace a new chat's first-message title with one written by the LLM.
+LLM_TITLES_ENABLED = os.environ.get("LLM_TITLES_ENABLED", "0") == "1"
+# Optional semantic cache for the first message of a chat, stored in Qdrant (QDRANT_URL,
+# or ":memory:" for an in-process store). Embeddings come from EMBEDDING_URL, or from
+# the /embeddings endpoint of the least busy LLM backend when it is not set.
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "0") == "1"
+QDRANT_URL = os.environ.get("QDRANT_URL", "http://qdrant-db:6333")
+SEMANTIC_CACHE_COLLECTION = os.environ.get("SEMANTIC_CACHE_COLLECTION", "chat_semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "86400"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+EMBEDDING_URL = os.environ.get("EMBEDDING_URL", "")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "")
+
+# Created in start_http_client() once the event loop is running.
+http_client = None
+backend_pool = BackendPool(LLM_CIRCUIT_FAILURES, LLM_CIRCUIT_OPEN_SECONDS)
+admission = AdmissionController(ADMISSION_MAX_PER_BACKEND, ADMISSION_MAX_QUEUE, ADMISSION_MAX_PER_SESSION)
+persistence = PersistenceQueue(PERSIST_QUEUE_SIZE, PERSIST_WORKERS, PERSIST_MAX_ATTEMPTS)
+generations = GenerationRegistry(STREAM_ABANDON_SECONDS, STREAM_RETAIN_SECONDS)
+# Created in start_background_tasks() when SEMANTIC_CACHE_ENABLED is set.
+semantic_cache = None
+_health_task = None
+
+
+@app.before_serving
+async def start_http_client():
+    global http_client
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        # LLM replies can stream for minutes, so only connecting is time-limited.
+        timeout=httpx.Timeout(None, connect=10.0),
+    )
+
+
+@app.before_serving
+async def start_background_tasks():
+    global _health_task, semantic_cache
+    persistence.start()
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_cache = SemanticCache(
+            AsyncQdrantClient(location=QDRANT_URL), SEMANTIC_CACHE_COLLECTION, SEMANTIC_CACHE_THRESHOLD,
+            SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_ENTRIES, payload_indexes=QDRANT_URL != ":memory:")
+    if LLM_HEALTH_INTERVAL > 0:
+        _health_task = asyncio.create_task(probe_backends())
+
+
+@app.after_serving
+async def stop_http_client():
+    if _health_task:
+        _health_task.cancel()
+    # Cut off replies still streaming, then store everything still queued
+    # before the client it needs goes away.
+    await generations.stop_all()
+    await persistence.drain(PERSIST_DRAIN_TIMEOUT)
+    if semantic_cache:
+        await semantic_cache.close()
+    await http_client.aclose()
+
+
+async def core_request(method, path, payload=None, **kwargs):
+    """Calls an internal core-service route, sending and accepting bodies in CORE_WIRE_FORMAT."""
+    mimetype = wire_mimetype(CORE_WIRE_FORMAT)
+    headers = {"Accept": mimetype, **kwargs.pop("headers", {})}
+    if payload is not None:
+        headers["Content-Type"] = mimetype
+        kwargs["content"] = encode(payload, mimetype)
+    return await http_client.request(method, f"{CORE_SERVICE_URL}{path}", headers=headers, **kwargs)
+
+
+# Last settings seen from core-service and their ETag, revalidated on every call.
+_settings_cache = {"etag": None, "settings": {}}
 
 
-def get_settings():
+async def get_settings():
+    headers = {}
+    if _settings_cache["etag"]:
+        headers["If-None-Match"] = _settings_cache["etag"]
     try:
-        response = requests.get(f"{CORE_SERVICE_URL}/api/core/settings")
+        response = await core_request("GET", "/api/core/settings", headers=headers)
+        if response.status_code == 304:
+            return _settings_cache["settings"]
         response.raise_for_status()
-        return response.json()
-    except requests.RequestException:
+        settings = decode(response)
+        _settings_cache["settings"] = settings
+        _settings_cache["etag"] = response.headers.get("ETag")
+        return settings
+    except httpx.HTTPError:
         # Return empty settings on failure
         return {}
 
 
+# --- LLM Backends ---
+def configured_backends(settings):
+    """Syncs the backend pool with the configuration and returns the configured URLs."""
+    urls = parse_backend_urls(LLM_BACKENDS or settings.get("lm_studio_url"))
+    backend_pool.update(urls)
+    if urls:
+        sync_admission_capacity()
+    return urls
+
+
+def sync_admission_capacity():
+    """Sizes admission to the backends whose circuit lets requests through, so open ones add no slots."""
+    admission.set_backend_count(backend_pool.available_count())
+
+
+def overloaded_response(error):
+    return Response(f"Server is busy: {error} Please retry in {error.retry_after} s.", status=429,
+                    headers={"Retry-After": str(error.retry_after)})
+
+
+async def probe_backends():
+    """Periodically health-checks every backend so failing hosts are skipped before a user hits them."""
+    while True:
+        await asyncio.sleep(LLM_HEALTH_INTERVAL)
+        if configured_backends(await get_settings()):
+            await backend_pool.probe(http_client, LLM_HEALTH_TIMEOUT)
+            sync_admission_capacity()
+
+
+# --- Session History Cache ---
+# session_id -> {"messages", "last_id", "epoch"}, least recently used first.
+# Only touched from the event loop, so no locking is needed.
+_history_cache = OrderedDict()
+
+
+def get_cached_history(session_id):
+    entry = _history_cache.get(session_id)
+    if entry is not None:
+        _history_cache.move_to_end(session_id)
+    return entry
+
+
+def update_cached_history(session_id, cached, delta):
+    """
+    Merges a history delta from core-service into the cached history and returns
+    the full, up-to-date message list.
+    """
+    if delta["reset"] or cached is None:
+        messages = delta["messages"]
+    else:
+        messages = cached["messages"] + delta["messages"]
+    _history_cache[session_id] = {"messages": messages, "last_id": delta["last_id"], "epoch": delta["epoch"]}
+    _history_cache.move_to_end(session_id)
+    while len(_history_cache) > HISTORY_CACHE_SIZE:
+        _history_cache.popitem(last=False)
+    return messages
+
+
+def invalidate_cached_history(session_id):
+    _history_cache.pop(session_id, None)
+
+
+async def sync_history(session_id):
+    """Brings the cached history up to date with core-service and returns it."""
+    cached = get_cached_history(session_id)
+    # An empty after_id asks core-service for a full reset.
+    params = {"after_id": cached["last_id"], "epoch": cached["epoch"]} if cached else {"after_id": ""}
+    response = await core_request("GET", f"/api/core/sessions/{session_id}/messages", params=params)
+    response.raise_for_status()
+    return update_cached_history(session_id, cached, decode(response))
+
+
+async def save_assistant_reply(session_id, full_reply, settings, first_message=None, stream_id=None):
+    """
+    Queues the finished reply to be stored in core-service, replacing the checkpoint
+    of `stream_id` if one was written. For a new chat (`first_message` given) an
+    LLM-written title is queued too, if enabled.
+    """
+    # Sent with every attempt, so core-service stores the reply once however often it is retried.
+    message = {"role": "assistant", "content": full_reply, "client_id": uuid.uuid4().hex}
+    if stream_id:
+        message["stream_id"] = stream_id
+
+    async def save():
+        (await core_request("POST", f"/api/core/sessions/{session_id}/messages", message)).raise_for_status()
+        schedule_compaction(session_id, settings)
+
+    await persistence.submit(save, f"saving the reply to session {session_id}", key=session_id)
+    if first_message and full_reply and LLM_TITLES_ENABLED:
+        async def retitle():
+            title = await call_llm(lambda url: generate_title(http_client, url, first_message, full_reply))
+            if title:
+                (await core_request("PUT", f"/api/core/sessions/{session_id}/rename",
+                                    {"title": title})).raise_for_status()
+
+        await persistence.submit(retitle, f"titling session {session_id}")
+
+
+async def call_llm(request):
+    """Runs a non-streaming `request(url)` on the least busy LLM backend, recording the outcome."""
+    backend = backend_pool.pick()
+    if backend is None:
+        raise httpx.ConnectError("No LLM backend available")
+    with backend_pool.lease(backend):
+        try:
+            result = await request(backend.url)
+        except httpx.HTTPError as e:
+            if is_backend_failure(e):
+                backend_pool.record_failure(backend, e)
+            raise
+        backend_pool.record_success(backend)
+        return result
+
+
+# --- Semantic Cache ---
+async def embed_prompt(system_prompt, user_message):
+    """Embeds a prompt-only request for the semantic cache; None if no embedding could be made."""
+    if EMBEDDING_URL:
+        url = EMBEDDING_URL
+    else:
+        # Not recorded against the backend: a host without an embedding model is still fine for chat.
+        backend = backend_pool.pick()
+        if backend is None:
+            return None
+        url = api_url(backend.url, "embeddings")
+    try:
+        return await embed(http_client, url, EMBEDDING_MODEL, f"{system_prompt}\n\n{user_message}")
+    except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+        logger.warning(f"Could not embed prompt for the semantic cache: {e}")
+        return None
+
+
+def replay_completion(session_id, reply, settings, first_message):
+    """Sends a cached reply as the response and stores it like a generated one."""
+    async def generate():
+        try:
+            yield reply.encode()
+        finally:
+            await asyncio.shield(save_assistant_reply(session_id, reply, settings, first_message))
+
+    return Response(generate(), mimetype='text/plain', headers={"X-Cache": "hit"})
+
+
+# --- Background Compaction ---
+# session_id -> running compaction task; at most one per session.
+_compaction_tasks = {}
+
+
+def schedule_compaction(session_id, settings):
+    if not COMPACTION_ENABLED or session_id in _compaction_tasks:
+        return
+    task = asyncio.create_task(compact_session(session_id, settings))
+    _compaction_tasks[session_id] = task
+    task.add_done_callback(lambda _: _compaction_tasks.pop(session_id, None))
+
+
+async def compact_session(session_id, settings):
+    """Summarizes a session's newly aged-out turns into a summary row, off the request path."""
+    try:
+        history = await sync_history(session_id)
+        context_limit = to_setting_int(settings.get('context_limit'), DEFAULT_CONTEXT_LIMIT)
+        plan = plan_compaction(history, context_limit, COMPACTION_TRIGGER_RATIO, COMPACTION_KEEP_RATIO)
+        if plan is None:
+            return
+        previous_summary, aged = plan
+        content = await call_llm(lambda url: summarize(http_client, url, previous_summary, aged))
+        from_id = previous_summary["summary_from_id"] if previous_summary else aged[0]["id"]
+        (await core_request("POST", f"/api/core/sessions/{session_id}/summaries",
+                            {"content": content, "from_id": from_id, "to_id": aged[-1]["id"]})).raise_for_status()
+        logger.info(f"Compacted session {session_id}: summarized messages {from_id}..{aged[-1]['id']}.")
+    except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+        logger.warning(f"Compaction failed for session {session_id}: {e}")
+
+
+def build_llm_payload(history, settings):
+    """Builds the streaming chat completion request, trimmed to the context_limit token budget."""
+    max_tokens = to_setting_int(settings.get('max_tokens'), -1)
+    context_limit = to_setting_int(settings.get('context_limit'), DEFAULT_CONTEXT_LIMIT)
+    return {
+        "messages": build_context(history, context_limit, max_tokens),
+        "max_tokens": settings.get('max_tokens', -1),
+        "stream": True
+    }
+
+
+def stream_completion(session_id, payload, settings, ticket, first_message=None, on_complete=None):
+    """
+    Starts generating the LLM reply in the background and streams it to the client.
+
+    The generation keeps running if the client disconnects: the client can reattach
+    through resume_stream() with the X-Stream-Id header and the number of bytes it
+    received. The queue position of the admission `ticket` is sent in X-Queue-Position.
+    """
+    generation = generations.start(session_id, lambda generation: run_generation(
+        generation, payload, settings, ticket, first_message, on_complete))
+    # run_generation releases the ticket when it ends; this also covers a task cancelled before it started.
+    generation.task.add_done_callback(lambda task: ticket.release())
+    return Response(generation.read(), mimetype='text/plain',
+                    headers={"X-Stream-Id": generation.stream_id, "X-Queue-Position": str(ticket.position)})
+
+
+async def run_generation(generation, payload, settings, ticket, first_message, on_complete):
+    """
+    Streams the reply from the LLM into `generation` and saves it to history when it ends.
+
+    Starts once the admission `ticket` is granted. The request goes to the least busy
+    backend; if that backend fails before the first token, the next one is tried.
+    A 4xx answer is not a backend failure: the reply ends with the backend's reason.
+    `on_complete(reply)` is queued in the background if the LLM finished the reply.
+    """
+    session_id = generation.session_id
+    reply_parts = []
+    tried = []
+    completed = False
+    checkpointer = asyncio.create_task(checkpoint_generation(generation, reply_parts))
+    try:
+        await ticket.wait()
+        while True:
+            backend = backend_pool.pick(exclude=tried)
+            if backend is None:
+                reason = "all backends failed" if tried else "no backend available"
+                generation.append(f"\nError connecting to LLM: {reason}".encode())
+                break
+            tried.append(backend.url)
+            started = time.monotonic()
+            sent = False
+            try:
+                with backend_pool.lease(backend):
+                    async with http_client.stream("POST", backend.url, json=payload) as lm_response:
+                        if lm_response.is_client_error:
+                            # Read the reason, so it can be passed on to the client.
+                            await lm_response.aread()
+                        lm_response.raise_for_status()
+                        async for chunk in coalesce_deltas(lm_response.aiter_bytes(), reply_parts, STREAM_FLUSH_BYTES,
+                                                           STREAM_FLUSH_INTERVAL_MS / 1000):
+                            if not sent:
+                                backend_pool.record_first_token(backend, time.monotonic() - started)
+                                sent = True
+                            generation.append(chunk)
+                backend_pool.record_success(backend, time.monotonic() - started)
+                completed = True
+                break
+            except httpx.HTTPError as e:
+                if not is_backend_failure(e):
+                    # The backend rejected the request itself; every other one would too.
+                    backend_pool.record_success(backend)
+                    logger.warning(f"LLM backend {backend.url} rejected the request: {e}")
+                    generation.append(f"\nThe LLM rejected the request: {e.response.text or e}".encode())
+                    break
+                backend_pool.record_failure(backend, e)
+                if sent:
+                    generation.append(f"\nError connecting to LLM: {e}".encode())
+                    break
+                logger.warning(f"LLM backend {backend.url} failed before the first token: {e}")
+                reply_parts.clear()
+    finally:
+        # A circuit may have opened or closed; resize before the freed slot is handed on.
+        sync_admission_capacity()
+        ticket.release()
+        generation.finish()
+        # Let a checkpoint being written land before the final save replaces it.
+        await asyncio.shield(checkpointer)
+        reply = "".join(reply_parts)
+        stream_id = generation.stream_id if generation.checkpointed else None
+        # Only queued here, so readers see the end of the stream right after the last token.
+        # Shielded so stopping the generation cannot drop the reply.
+        await asyncio.shield(save_assistant_reply(session_id, reply, settings, first_message, stream_id))
+        if completed and reply and on_complete:
+            await asyncio.shield(persistence.submit(lambda: on_complete(reply), f"post-processing session {session_id}"))
+
+
+async def checkpoint_generation(generation, reply_parts):
+    """Saves the reply so far to core-service every STREAM_CHECKPOINT_INTERVAL seconds until it is finished."""
+    saved_parts = 0
+    while True:
+        try:
+            await asyncio.wait_for(generation.finished.wait(), STREAM_CHECKPOINT_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        if len(reply_parts) == saved_parts:
+            continue
+        saved_parts = len(reply_parts)
+        generation.checkpointed = True
+        try:
+            (await core_request(
+                "PUT", f"/api/core/sessions/{generation.session_id}/streams/{generation.stream_id}",
+                {"content": "".join(reply_parts)})).raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"Could not checkpoint stream {generation.stream_id}: {e}")
+
+
 @app.route(f"{API_PREFIX}/<session_id>", methods=["POST"])
-def chat(session_id):
-    data = request.get_json()
+async def chat(session_id):
+    data = await request.get_json()
     user_message = data.get("message", "")
     if not user_message:
         return Response("No message provided.", status=400)
 
-    settings = get_settings()
-    lm_studio_url = settings.get("lm_studio_url")
-    if not lm_studio_url:
+    settings = await get_settings()
+    if not configured_backends(settings):
         return Response("LM Studio URL not configured.", status=500)
+    try:
+        ticket = admission.enqueue(session_id)
+    except Overloaded as e:
+        return overloaded_response(e)
 
+    # Until the ticket is handed to the generation, any way out of here (an error, a
+    # reply from the semantic cache, the client going away) must free its slot.
     try:
-        # 1. Get history from core-service
-        messages_resp = requests.get(f"{CORE_SERVICE_URL}/api/core/sessions/{session_id}/messages")
-        messages_resp.raise_for_status()
-        current_history = messages_resp.json()
-        is_new_chat = len(current_history) <= 1
-
-        # 2. Add new user message to history (in core-service)
-        add_msg_payload = {"role": "user", "content": user_message}
-        requests.post(f"{CORE_SERVICE_URL}/api/core/sessions/{session_id}/messages",
-                      json=add_msg_payload).raise_for_status()
-        current_history.append(add_msg_payload)
-
-    except requests.RequestException as e:
-        return Response(f"Error communicating with core service: {e}", status=500)
+        try:
+            # The previous reply must be finished and stored before the next message is appended.
+            await generations.stop_session(session_id)
+            await persistence.settled(session_id)
+            # 1. Add new user message and get the history we have not seen yet in one call (in core-service).
+            # The title only applies if this is the chat's first message.
+            cached = get_cached_history(session_id)
+            title = user_message[:40] + ('...' if len(user_message) > 40 else '')
+            add_msg_payload = {"role": "user", "content": user_message, "title": title}
+            if cached:
+                add_msg_payload.update(after_id=cached["last_id"], epoch=cached["epoch"])
+            messages_resp = await core_request(
+                "POST", f"/api/core/sessions/{session_id}/messages/append", add_msg_payload)
+            messages_resp.raise_for_status()
+            current_history = update_cached_history(session_id, cached, decode(messages_resp))
+            # Only the system prompt and the message just added
+            is_new_chat = len(current_history) <= 2
 
-    payload = {
-        "messages": current_history,
-        "max_tokens": settings.get('max_tokens', -1),
-        "stream": True
-    }
+        except httpx.HTTPError as e:
+            invalidate_cached_history(session_id)
+            return Response(f"Error communicating with core service: {e}", status=500)
 
-    def generate():
-        full_reply = ""
-        try:
-            with requests.post(lm_studio_url, json=payload, stream=True) as lm_response:
-                lm_response.raise_for_status()
-                for line in lm_response.iter_lines(decode_unicode=True):
-                    if line and line.startswith("data:"):
-                        line_data = line[5:].strip()
-                        if line_data == "[DONE]":
-                            break
-                        try:
-                            content = json.loads(line_data)['choices'][0]['delta'].get('content', '')
-                            if content:
-                                full_reply += content
-                                yield content
-                        except (json.JSONDecodeError, KeyError, IndexError):
-                            continue
-        except requests.exceptions.RequestException as e:
-            yield f"\nError connecting to LLM: {e}"
-        finally:
-            # 3. Add final assistant message to history (in core-service)
-            requests.post(f"{CORE_SERVICE_URL}/api/core/sessions/{session_id}/messages",
-                          json={"role": "assistant", "content": full_reply}).raise_for_status()
-            if is_new_chat:
-                title = user_message[:40] + ('...' if len(user_message) > 40 else '')
-                requests.put(f"{CORE_SERVICE_URL}/api/core/sessions/{session_id}/rename",
-                             json={"title": title}).raise_for_status()
+        # 2. The first message of a chat depends only on the system prompt, so a semantically
+        # equivalent earlier request can answer it without the LLM.
+        first_message = user_message if is_new_chat else None
+        on_complete = None
+        if semantic_cache and is_new_chat:
+            system_prompt = current_history[0]["content"] if current_history[0].get("role") == "system" else ""
+            key = prompt_hash(system_prompt)
+            vector = await embed_prompt(system_prompt, user_message)
+            if vector is not None:
+                cached_reply = await semantic_cache.lookup(vector, key)
+                if cached_reply is not None:
+                    return replay_completion(session_id, cached_reply, settings, first_message)
+                on_complete = lambda reply: semantic_cache.store(vector, key, reply)
 
-    return Response(stream_with_context(generate()), mimetype='text/plain')
+        # 3. Stream the reply; the final assistant message is added to history (in core-service) when it ends
+        payload = build_llm_payload(current_history, settings)
+        response = stream_completion(session_id, payload, settings, ticket, first_message, on_complete)
+        ticket = None
+        return response
+    finally:
+        if ticket is not None:
+            ticket.release()
 
 
 @app.route(f"{API_PREFIX}/<session_id>/regenerate", methods=["POST"])
-def regenerate(session_id):
-    settings = get_settings()
-    lm_studio_url = settings.get("lm_studio_url")
-    if not lm_studio_url:
+async def regenerate(session_id):
+    settings = await get_settings()
+    if not configured_backends(settings):
         return Response("LM Studio URL not configured.", status=500)
+    try:
+        ticket = admission.enqueue(session_id)
+    except Overloaded as e:
+        return overloaded_response(e)
 
+    # As in chat(): the slot is freed on every way out but handing the ticket to the generation.
     try:
-        # 1. Delete last message in core-service
-        requests.post(f"{CORE_SERVICE_URL}/api/core/sessions/{session_id}/regenerate").raise_for_status()
-
-        # 2. Get updated history
-        messages_resp = requests.get(f"{CORE_SERVICE_URL}/api/core/sessions/{session_id}/messages")
-        messages_resp.raise_for_status()
-        current_history = messages_resp.json()
-    except requests.RequestException as e:
+        try:
+            # The reply being regenerated must be finished and stored before it can be deleted.
+            await generations.stop_session(session_id)
+            await persistence.settled(session_id)
+            # 1. Delete last message and get the updated history in one call (in core-service)
+            invalidate_cached_history(session_id)
+            messages_resp = await core_request("POST", f"/api/core/sessions/{session_id}/regenerate/history")
+            messages_resp.raise_for_status()
+            current_history = update_cached_history(session_id, None, decode(messages_resp))
+        except httpx.HTTPError as e:
+            return Response(f"Error communicating with core service: {e}", status=500)
+
+        # 2. Stream the new reply; it is added to history when the stream ends
+        payload = build_llm_payload(current_history, settings)
+        response = stream_completion(session_id, payload, settings, ticket)
+        ticket = None
+        return response
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+@app.route(f"{API_PREFIX}/<session_id>/streams/<stream_id>", methods=["GET", "DELETE"])
+async def resume_stream(session_id, stream_id):
+    """
+    GET reattaches to a reply from byte `offset` (what the client already received).
+    While the generation runs or was recently finished, this follows the live stream;
+    after that, the last checkpoint in core-service is served if the reply was cut off.
+    DELETE stops the generation, e.g. when the user presses stop.
+    """
+    generation = generations.get(stream_id)
+    if generation and generation.session_id != session_id:
+        generation = None
+    if request.method == "DELETE":
+        if generation is None:
+            return Response("Stream not found.", status=404)
+        await generations.stop(generation)
+        return jsonify({"success": True})
+
+    offset = request.args.get("offset", 0, type=int)
+    if offset < 0:
+        return Response("Invalid offset.", status=400)
+    if generation:
+        return Response(generation.read(offset), mimetype='text/plain', headers={"X-Stream-Id": stream_id})
+    try:
+        response = await core_request("GET", f"/api/core/sessions/{session_id}/streams/{stream_id}")
+        if response.status_code == 404:
+            return Response("Stream not found; reload the session to see the stored reply.", status=404)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
         return Response(f"Error communicating with core service: {e}", status=500)
+    return Response(decode(response)["content"].encode()[offset:], mimetype='text/plain',
+                    headers={"X-Stream-Id": stream_id})
 
-    payload = {"messages": current_history, "max_tokens": settings.get('max_tokens', -1), "stream": True}
 
-    def generate():
-        full_reply = ""
-        try:
-            with requests.post(lm_studio_url, json=payload, stream=True) as lm_response:
-                # ... (streaming logic is identical to chat endpoint)
-                lm_response.raise_for_status()
-                for line in lm_response.iter_lines(decode_unicode=True):
-                    if line and line.startswith("data:"):
-                        line_data = line[5:].strip()
-                        if line_data == "[DONE]": break
-                        try:
-                            content = json.loads(line_data)['choices'][0]['delta'].get('content', '')
-                            if content:
-                                full_reply += content
-                                yield content
-                        except (json.JSONDecodeError, KeyError, IndexError):
-                            continue
-        except requests.exceptions.RequestException as e:
-            yield f"\nError connecting to LLM: {e}"
-        finally:
-            # 3. Add new assistant message to history
-            requests.post(f"{CORE_SERVICE_URL}/api/core/sessions/{session_id}/messages",
-                          json={"role": "assistant", "content": full_reply}).raise_for_status()
+@app.route(f"{API_PREFIX}/backends", methods=["GET"])
+async def backend_stats():
+    """Per-backend state, in-flight requests and latency averages as seen by this worker."""
+    configured_backends(await get_settings())
+    return jsonify({"backends": backend_pool.stats()})
+
+
+@app.route(f"{API_PREFIX}/admission", methods=["GET"])
+async def admission_stats():
+    """Concurrency, queue depth and wait-time histograms as seen by this worker."""
+    return jsonify(admission.stats())
+
+
+@app.route(f"{API_PREFIX}/<session_id>/queue", methods=["GET"])
+async def queue_position(session_id):
+    """Queue position of the session's next waiting request; null when nothing is waiting."""
+    return jsonify({"position": admission.session_position(session_id)})
+
 
-    return Response(stream_with_context(generate()), mimetype='text/plain')
\ No newline at end of file
+@app.route(f"{API_PREFIX}/cache", methods=["GET"])
+async def cache_stats():
+    """Semantic cache hit rate and eviction counts as seen by this worker."""
+    if not semantic_cache:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **semantic_cache.stats()})
@@ -0,0 +1,101 @@
+# File: services/chat-services/app/persistence.py
+
+import random
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def is_retryable(error):
+    """Connection problems and 5xx responses are worth retrying; other 4xx responses are not."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.HTTPError)
+
+
+class PersistenceQueue:
+    """
+    Runs post-stream bookkeeping (saving replies, titling chats) off the response path.
+
+    Jobs are coroutine functions executed by a few worker tasks; a job failing with
+    a retryable error is retried with exponential backoff up to `max_attempts`
+    times. Jobs submitted with a `key` are tracked so `settled(key)` can wait for
+    them, which lets a session's next request see its previous reply stored.
+    The queue is bounded, so `submit` waits for room when core-service falls
+    far behind. `drain` finishes the queued jobs on shutdown.
+    """
+
+    def __init__(self, max_size=1000, workers=2, max_attempts=5, backoff_base=0.5, backoff_max=10.0):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._worker_count = workers
+        self._queue = asyncio.Queue(max_size)
+        self._workers = []
+        # key -> [pending job count, Event set when it reaches zero]
+        self._pending = {}
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self._worker_count)]
+
+    async def submit(self, job, label, key=None):
+        if key is not None:
+            entry = self._pending.setdefault(key, [0, asyncio.Event()])
+            entry[0] += 1
+            entry[1].clear()
+        await self._queue.put((job, label, key))
+
+    async def settled(self, key):
+        """Waits until every job submitted under `key` has finished (or given up)."""
+        entry = self._pending.get(key)
+        if entry:
+            await entry[1].wait()
+
+    async def _work(self):
+        while True:
+            job, label, key = await self._queue.get()
+            try:
+                await self._run(job, label)
+            finally:
+                self._queue.task_done()
+                if key is not None:
+                    entry = self._pending[key]
+                    entry[0] -= 1
+                    if entry[0] == 0:
+                        entry[1].set()
+                        del self._pending[key]
+
+    async def _run(self, job, label):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await job()
+                self.completed += 1
+                return
+            except Exception as e:
+                if attempt == self.max_attempts or not is_retryable(e):
+                    self.failed += 1
+                    logger.error(f"Giving up on {label} after {attempt} attempt(s): {e}")
+                    return
+                self.retried += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                logger.warning(f"{label} failed ({e}); retrying in {delay:.1f} s.")
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+
+    async def drain(self, timeout):
+        """Lets queued jobs finish for up to `timeout` seconds, then stops the workers."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Shutting down with {self._queue.qsize()} bookkeeping job(s) still queued.")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "completed": self.completed,
+                "failed": self.failed, "retried": self.retried}
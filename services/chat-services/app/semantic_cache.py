@@ -0,0 +1,141 @@
+# File: services/chat-services/app/semantic_cache.py
+
+import time
+import uuid
+import hashlib
+import logging
+from qdrant_client import models
+
+logger = logging.getLogger(__name__)
+
+# Expired entries are purged at most this often, on the store path.
+PURGE_INTERVAL_SECONDS = 60
+
+
+def prompt_hash(system_prompt):
+    """Entries only match requests with the exact same system prompt."""
+    return hashlib.sha256((system_prompt or "").encode()).hexdigest()
+
+
+async def embed(http_client, embeddings_url, model, text):
+    """Embeds `text` with an OpenAI-compatible /embeddings endpoint (LM Studio serves one)."""
+    body = {"input": text}
+    if model:
+        body["model"] = model
+    response = await http_client.post(embeddings_url, json=body)
+    response.raise_for_status()
+    return response.json()['data'][0]['embedding']
+
+
+class SemanticCache:
+    """
+    Replies to prompt-only requests, looked up by embedding similarity in Qdrant.
+
+    An entry holds the embedding of a system prompt plus the first user message
+    and the reply the LLM gave. A lookup hits when an entry for the same system
+    prompt scores at least `threshold` (cosine) and is younger than
+    `ttl_seconds`. Each hit refreshes the entry's last-used time; once there are
+    more than `max_entries` the least recently used are deleted. The collection
+    is created on the first store, sized to the embedding model. Qdrant errors
+    are logged and counted, never raised: the cache must not break a chat.
+    """
+
+    def __init__(self, client, collection, threshold=0.95, ttl_seconds=86400, max_entries=10000,
+                 payload_indexes=True):
+        self.client = client
+        self.collection = collection
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # Payload indexes only exist in server Qdrant; the in-memory mode warns about them.
+        self.payload_indexes = payload_indexes
+        self._vector_size = None
+        self._last_purge = 0.0
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+
+    async def _ensure_collection(self, size):
+        if self._vector_size == size:
+            return
+        if await self.client.collection_exists(self.collection):
+            info = await self.client.get_collection(self.collection)
+            existing = info.config.params.vectors.size
+            if existing == size:
+                self._vector_size = size
+                return
+            # The embedding model changed; entries from the old one cannot be compared.
+            logger.warning(f"Recreating semantic cache: embedding size changed from {existing} to {size}.")
+            await self.client.delete_collection(self.collection)
+        await self.client.create_collection(
+            self.collection, vectors_config=models.VectorParams(size=size, distance=models.Distance.COSINE))
+        if self.payload_indexes:
+            await self.client.create_payload_index(self.collection, "prompt_hash", models.PayloadSchemaType.KEYWORD)
+            await self.client.create_payload_index(self.collection, "created_at", models.PayloadSchemaType.FLOAT)
+            await self.client.create_payload_index(self.collection, "last_used_at", models.PayloadSchemaType.FLOAT)
+        self._vector_size = size
+
+    async def lookup(self, vector, key):
+        """Returns the cached reply for the nearest matching entry, or None on a miss."""
+        self.lookups += 1
+        now = time.time()
+        try:
+            if self._vector_size is None and not await self.client.collection_exists(self.collection):
+                return None
+            results = await self.client.search(
+                self.collection, query_vector=vector, limit=1, score_threshold=self.threshold,
+                query_filter=models.Filter(must=[
+                    models.FieldCondition(key="prompt_hash", match=models.MatchValue(value=key)),
+                    models.FieldCondition(key="created_at", range=models.Range(gte=now - self.ttl_seconds)),
+                ]))
+            if not results:
+                return None
+            await self.client.set_payload(self.collection, payload={"last_used_at": now}, points=[results[0].id])
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
+        self.hits += 1
+        return results[0].payload["reply"]
+
+    async def store(self, vector, key, reply):
+        now = time.time()
+        try:
+            await self._ensure_collection(len(vector))
+            await self.client.upsert(self.collection, [models.PointStruct(
+                id=str(uuid.uuid4()), vector=vector,
+                payload={"prompt_hash": key, "reply": reply, "created_at": now, "last_used_at": now})])
+            self.stores += 1
+            await self._evict(now)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Semantic cache store failed: {e}")
+
+    async def _evict(self, now):
+        if now - self._last_purge >= PURGE_INTERVAL_SECONDS:
+            self._last_purge = now
+            await self.client.delete(self.collection, points_selector=models.FilterSelector(filter=models.Filter(
+                must=[models.FieldCondition(key="created_at", range=models.Range(lt=now - self.ttl_seconds))])))
+        excess = (await self.client.count(self.collection, exact=True)).count - self.max_entries
+        if excess > 0:
+            oldest, _ = await self.client.scroll(
+                self.collection, limit=excess, with_payload=False,
+                order_by=models.OrderBy(key="last_used_at", direction=models.Direction.ASC))
+            await self.client.delete(self.collection, points_selector=models.PointIdsList(
+                points=[point.id for point in oldest]))
+            self.evictions += len(oldest)
+
+    async def close(self):
+        await self.client.close()
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else None,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
@@ -0,0 +1,111 @@
+# File: services/chat-services/app/streaming.py
+
+import asyncio
+import orjson
+
+
+class SSEDecoder:
+    """
+    Incremental decoder for an OpenAI-compatible SSE stream.
+
+    Works on raw byte chunks as they come off the socket, so lines split across
+    chunks are handled without decoding the whole stream to text first. Only
+    choices[0].delta.content is extracted; events without a "content" key
+    (role announcements, finish reasons) are skipped without parsing any JSON.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self.done = False
+
+    def feed(self, chunk):
+        """Consumes a chunk of bytes and returns the content fragments it completed."""
+        lines = (self._buffer + chunk).split(b"\n")
+        self._buffer = lines.pop()
+        contents = []
+        for line in lines:
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                self.done = True
+                break
+            if b'"content"' not in data:
+                continue
+            try:
+                content = orjson.loads(data)['choices'][0]['delta'].get('content')
+            except (orjson.JSONDecodeError, KeyError, IndexError, TypeError, AttributeError):
+                continue
+            if content:
+                contents.append(content)
+        return contents
+
+
+async def coalesce_deltas(byte_chunks, reply_parts, flush_bytes=256, flush_interval=0.04):
+    """
+    Decodes an SSE byte stream and yields the reply text in coalesced UTF-8 chunks.
+
+    The upstream is drained by a reader task, which wakes this generator once
+    `flush_bytes` are buffered or `flush_interval` seconds after the first fragment
+    since the last flush, so a stalled upstream still gets its pending text out.
+    The first fragment is sent immediately so time-to-first-token is unchanged.
+    Every fragment is appended to `reply_parts` so the caller can join the full
+    reply once at the end. Errors from `byte_chunks` are re-raised here.
+    """
+    loop = asyncio.get_running_loop()
+    decoder = SSEDecoder()
+    wakeup = asyncio.Event()
+    state = {"buffer": [], "bytes": 0, "first": True, "timer": None, "error": None, "finished": False}
+
+    def flush_soon():
+        if state["timer"] is not None:
+            state["timer"].cancel()
+            state["timer"] = None
+        wakeup.set()
+
+    async def read():
+        try:
+            async for chunk in byte_chunks:
+                contents = decoder.feed(chunk)
+                if not contents:
+                    continue
+                buffer = state["buffer"]
+                was_empty = not buffer
+                for content in contents:
+                    reply_parts.append(content)
+                    encoded = content.encode()
+                    buffer.append(encoded)
+                    state["bytes"] += len(encoded)
+                if state["first"] or state["bytes"] >= flush_bytes:
+                    flush_soon()
+                elif was_empty:
+                    state["timer"] = loop.call_later(flush_interval, flush_soon)
+                if decoder.done:
+                    break
+        except Exception as e:
+            state["error"] = e
+        finally:
+            state["finished"] = True
+            flush_soon()
+
+    reader = asyncio.create_task(read())
+    try:
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            if state["buffer"]:
+                chunk = b"".join(state["buffer"])
+                state["buffer"] = []
+                state["bytes"] = 0
+                state["first"] = False
+                yield chunk
+            if state["finished"] and not state["buffer"]:
+                break
+        if state["error"] is not None:
+            raise state["error"]
+    finally:
+        if state["timer"] is not None:
+            state["timer"].cancel()
+        if not reader.done():
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
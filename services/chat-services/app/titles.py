@@ -0,0 +1,28 @@
+# File: services/chat-services/app/titles.py
+
+TITLE_MAX_TOKENS = 24
+# Longest title stored; matches the length of the heuristic titles plus some slack.
+MAX_TITLE_LENGTH = 60
+# Only the start of the exchange is sent; it is enough to name the chat.
+EXCERPT_CHARS = 1000
+TITLE_PROMPT = (
+    "Write a short title of at most six words for the conversation below. "
+    "Reply with the title only, without quotes."
+)
+
+
+async def generate_title(http_client, lm_studio_url, user_message, reply):
+    """Asks the LLM to name a new chat from its first exchange; returns None if it gave nothing usable."""
+    response = await http_client.post(lm_studio_url, json={
+        "messages": [{"role": "system", "content": TITLE_PROMPT},
+                     {"role": "user", "content": f"user: {user_message[:EXCERPT_CHARS]}\n"
+                                                 f"assistant: {reply[:EXCERPT_CHARS]}"}],
+        "max_tokens": TITLE_MAX_TOKENS,
+        "stream": False,
+    })
+    response.raise_for_status()
+    content = response.json()['choices'][0]['message']['content'].strip()
+    title = content.splitlines()[0].strip().strip('"\'').strip() if content else ""
+    if len(title) > MAX_TITLE_LENGTH:
+        title = title[:MAX_TITLE_LENGTH].rstrip() + '...'
+    return title or None
@@ -0,0 +1,27 @@
+# File: services/chat-services/app/wire.py
+
+import orjson
+import msgpack
+
+MSGPACK_MIMETYPE = "application/msgpack"
+JSON_MIMETYPE = "application/json"
+WIRE_FORMATS = {"msgpack": MSGPACK_MIMETYPE, "json": JSON_MIMETYPE}
+
+
+def wire_mimetype(wire_format):
+    """The media type for a CORE_WIRE_FORMAT value; unknown values fall back to JSON."""
+    return WIRE_FORMATS.get(wire_format, JSON_MIMETYPE)
+
+
+def encode(payload, mimetype):
+    return msgpack.packb(payload) if mimetype == MSGPACK_MIMETYPE else orjson.dumps(payload)
+
+
+def decode(response):
+    """
+    Decodes a core-service response by its Content-Type, so a core-service that only
+    speaks JSON (or answers an error page) is still understood.
+    """
+    if response.headers.get("Content-Type", "").startswith(MSGPACK_MIMETYPE):
+        return msgpack.unpackb(response.content)
+    return orjson.loads(response.content)
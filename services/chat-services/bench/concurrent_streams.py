@@ -0,0 +1,117 @@
+"""
+Many chat streams at once through a running chat-service, each on its own
+session: wall time, time to first token, and how many chunks each client
+received. Given the server's pid (Linux), also its resident memory and CPU
+time, counted over the process and its children.
+
+    python bench/concurrent_streams.py --streams 100 --pid "$(pgrep -of 'hypercorn.*main:app')"
+
+Run bench/stub_llm.py with a per-token delay (e.g. --tokens 50 --delay-ms 40)
+so the streams overlap.
+"""
+import argparse
+import asyncio
+import os
+import time
+import httpx
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_tree(pid):
+    """pid and all of its descendants, read from /proc."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except OSError:
+                continue
+    tree = [pid]
+    for member in tree:
+        tree.extend(child for child, parent in parents.items() if parent == member)
+    return tree
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            continue
+    return total
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+        except OSError:
+            continue
+    return total
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.streams + 10)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        session_ids = [(await client.post(f"{args.core}/api/sessions", json={"prompt": "You are a helpful assistant."})).json()["id"]
+                       for _ in range(args.streams)]
+        pids = process_tree(args.pid) if args.pid else []
+        first_token = []
+        chunks = 0
+
+        async def stream(session_id):
+            nonlocal chunks
+            start = time.perf_counter()
+            received = 0
+            async with client.stream("POST", f"{args.chat}/api/chat/{session_id}", json={"message": "hi"}) as response:
+                async for _ in response.aiter_raw():
+                    if not received:
+                        first_token.append(time.perf_counter() - start)
+                    received += 1
+            chunks += received
+
+        idle_rss = peak_rss = rss_bytes(pids)
+        cpu_before = cpu_seconds(pids)
+
+        async def sample_rss():
+            nonlocal peak_rss
+            while True:
+                peak_rss = max(peak_rss, rss_bytes(pids))
+                await asyncio.sleep(0.05)
+
+        sampler = asyncio.create_task(sample_rss()) if pids else None
+        start = time.perf_counter()
+        await asyncio.gather(*(stream(session_id) for session_id in session_ids))
+        wall = time.perf_counter() - start
+        if sampler:
+            sampler.cancel()
+
+    first_token.sort()
+    print(f"{args.streams} streams: wall {wall:.2f} s  TTFT p50 {first_token[len(first_token) // 2] * 1000:.0f} ms  "
+          f"max {first_token[-1] * 1000:.0f} ms  {chunks / args.streams:.0f} chunks/stream")
+    if pids:
+        used = cpu_seconds(pids) - cpu_before
+        print(f"  server: RSS idle {idle_rss / 2 ** 20:.1f} MiB  peak {peak_rss / 2 ** 20:.1f} MiB  "
+              f"({(peak_rss - idle_rss) / args.streams / 1024:.0f} KiB/stream)  "
+              f"CPU {used:.2f} s ({used / args.streams * 1000:.0f} ms/stream)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--core", default="http://127.0.0.1:5000", help="core-service base URL")
+    parser.add_argument("--chat", default="http://127.0.0.1:5001", help="chat-service base URL")
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--pid", type=int, help="chat-service server pid, for memory and CPU figures")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+CPU cost of turning an upstream SSE stream into client writes, without any
+network: a recorded-style stream of N token events is served by an httpx
+MockTransport in odd-sized chunks (splitting lines and multibyte characters)
+and read either the way chat() used to (aiter_lines + json.loads per event,
+one write per token) or through streaming.coalesce_deltas.
+
+    python bench/sse_decode.py --tokens 4000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app"))
+from streaming import coalesce_deltas
+
+CHUNK_SIZE = 97
+
+
+def make_body(tokens):
+    events = [b'data: {"choices":[{"delta":{"role":"assistant"}}]}\n\n']
+    for i in range(tokens):
+        chunk = {"id": "bench", "object": "chat.completion.chunk",
+                 "choices": [{"index": 0, "delta": {"content": f"tok{i} é"}, "finish_reason": None}]}
+        events.append(f"data: {json.dumps(chunk)}\n\n".encode())
+    events.append(b"data: [DONE]\n\n")
+    return b"".join(events)
+
+
+def make_client(body):
+    class Stream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            for i in range(0, len(body), CHUNK_SIZE):
+                yield body[i:i + CHUNK_SIZE]
+                await asyncio.sleep(0)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=Stream())))
+
+
+async def line_by_line(client):
+    """The loop chat() and regenerate() each carried before the streaming module."""
+    full_reply = ""
+    writes = 0
+    async with client.stream("POST", "http://llm/v1/chat/completions") as response:
+        async for line in response.aiter_lines():
+            if line and line.startswith("data:"):
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    content = json.loads(data)["choices"][0]["delta"].get("content", "")
+                    if content:
+                        full_reply += content
+                        writes += 1
+                except (json.JSONDecodeError, KeyError, IndexError):
+                    continue
+    return full_reply, writes
+
+
+async def coalesced(client):
+    parts = []
+    writes = 0
+    async with client.stream("POST", "http://llm/v1/chat/completions") as response:
+        async for _ in coalesce_deltas(response.aiter_bytes(), parts):
+            writes += 1
+    return "".join(parts), writes
+
+
+async def run(tokens, repeats):
+    expected = "".join(f"tok{i} é" for i in range(tokens))
+    async with make_client(make_body(tokens)) as client:
+        for name, read in (("line by line (before)", line_by_line), ("coalesce_deltas", coalesced)):
+            reply, writes = await read(client)
+            assert reply == expected, name
+            best = None
+            for _ in range(repeats):
+                start = time.process_time()
+                await read(client)
+                used = time.process_time() - start
+                best = used if best is None else min(best, used)
+            print(f"{name:22s} {tokens / best:9,.0f} tokens/s  {best * 1000:6.1f} ms CPU/stream  {writes} client writes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=4000)
+    parser.add_argument("--repeats", type=int, default=5, help="the best of this many runs is reported")
+    args = parser.parse_args()
+    asyncio.run(run(args.tokens, args.repeats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+A stand-in OpenAI-compatible LLM for the chat-service benchmarks, on the
+standard library only. Streams --tokens tokens --delay-ms apart, answers
+non-streaming requests (conversation summaries) at once, and serves
+/v1/models and /v1/embeddings.
+
+    python bench/stub_llm.py --port 1234 --tokens 50 --delay-ms 40
+"""
+import argparse
+import json
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_SIZE = 64
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    # HTTP/1.0: every response ends by closing the connection, so streams need no chunked encoding.
+    protocol_version = "HTTP/1.0"
+    # Each token is its own small write; without TCP_NODELAY they wait for delayed ACKs.
+    disable_nagle_algorithm = True
+    tokens = 20
+    delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json({"data": [{"id": "stub"}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if self.path.endswith("/embeddings"):
+            # Bag-of-words vectors, so related texts still come out close together.
+            vector = [0.0] * EMBEDDING_SIZE
+            for word in str(body.get("input", "")).lower().replace("?", " ").replace(",", " ").split():
+                vector[zlib.crc32(word.encode()) % EMBEDDING_SIZE] += 1.0
+            self.send_json({"data": [{"embedding": vector}]})
+        elif not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+        elif body.get("stream") is False:
+            self.send_json({"choices": [{"message": {"role": "assistant", "content": "A summary."}}]})
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for i in range(self.tokens):
+                if self.delay:
+                    time.sleep(self.delay)
+                chunk = {"choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # many benchmark streams connect at once
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--tokens", type=int, default=20, help="tokens per streamed reply")
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="pause before each token")
+    args = parser.parse_args()
+
+    StubLLMHandler.tokens = args.tokens
+    StubLLMHandler.delay = args.delay_ms / 1000
+    StubLLMServer((args.host, args.port), StubLLMHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Time to first token of chat and regenerate through a running chat-service:
+the time from sending the request until the first byte of the reply arrives,
+which covers every core-service round trip made before the LLM is called.
+
+    python bench/ttft.py --core http://127.0.0.1:5000 --chat http://127.0.0.1:5001 --history 100
+
+core-service's lm_studio_url setting should point at bench/stub_llm.py.
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+
+
+def post(url, payload=None):
+    request = urllib.request.Request(url, data=json.dumps(payload or {}).encode(), method="POST",
+                                     headers={"Content-Type": "application/json"})
+    return urllib.request.urlopen(request)
+
+
+def first_byte_seconds(url, payload=None):
+    """Seconds until the first byte of a POST's reply; the rest is drained."""
+    start = time.perf_counter()
+    with post(url, payload) as response:
+        response.read(1)
+        elapsed = time.perf_counter() - start
+        response.read()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--core", default="http://127.0.0.1:5000", help="core-service base URL")
+    parser.add_argument("--chat", default="http://127.0.0.1:5001", help="chat-service base URL")
+    parser.add_argument("--history", type=int, default=100, help="messages in the session beforehand")
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    with post(f"{args.core}/api/sessions", {"prompt": "You are a helpful assistant."}) as response:
+        session_id = json.load(response)["id"]
+    for i in range(args.history):
+        post(f"{args.core}/api/core/sessions/{session_id}/messages",
+             {"role": "user" if i % 2 == 0 else "assistant", "content": "history " * 50}).close()
+
+    chat, regenerate = [], []
+    for _ in range(args.runs):
+        chat.append(first_byte_seconds(f"{args.chat}/api/chat/{session_id}", {"message": "hi"}))
+        regenerate.append(first_byte_seconds(f"{args.chat}/api/chat/{session_id}/regenerate"))
+
+    print(f"{args.history}-message session, median of {args.runs}: "
+          f"chat TTFT {statistics.median(chat) * 1000:.2f} ms  "
+          f"regenerate TTFT {statistics.median(regenerate) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,92 @@
 import sqlite3
 import json
+import threading
+import queue
+import time
+import atexit
+import zlib
+import html
 from pathlib import Path
 import os
 
 DATABASE_NAME = "data/database.db"
 
+# Pragmas applied to every pooled connection. WAL lets readers keep working
+# while a writer commits, and synchronous=NORMAL is durable across process
+# crashes in WAL mode (only an OS crash can lose the last transactions).
+SQLITE_PRAGMAS = {
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE_KB", "-20000")),  # negative = KiB
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "temp_store": "MEMORY",
+}
+# Characters of the newest message kept on each session for the sidebar preview.
+PREVIEW_LENGTH = 120
+# Sessions idle for longer than this are moved to compressed cold storage by
+# archive_idle_sessions(). Archived messages are not searchable until the session
+# is used again and moves back into the messages table.
+ARCHIVE_IDLE_DAYS = float(os.environ.get("ARCHIVE_IDLE_DAYS", "30"))
+ARCHIVE_COMPRESSION_LEVEL = 6
+# Marks FTS5 puts around matched terms in search snippets; swapped for <mark> tags
+# once the snippet text has been HTML-escaped.
+SNIPPET_MARK_START, SNIPPET_MARK_END = "\x02", "\x03"
+# Rough characters-per-token ratio used to estimate message token counts.
+CHARS_PER_TOKEN = 4
+# Size of sqlite3's per-connection prepared statement cache.
+STATEMENT_CACHE_SIZE = 256
+# How long a starting worker waits for another one to finish creating and
+# migrating the schema; a backfill on a large database can take a while.
+MIGRATION_BUSY_TIMEOUT_MS = int(os.environ.get("MIGRATION_BUSY_TIMEOUT_MS", "300000"))
 
-def get_db():
-    """Establishes a connection to the database."""
-    db = sqlite3.connect(DATABASE_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
+# Optional write-behind mode for add_message: inserts are queued and a single
+# writer thread commits them in batches (group commit).
+#   WRITE_BEHIND_DURABILITY=commit  add_message returns once its batch is committed.
+#   WRITE_BEHIND_DURABILITY=async   add_message returns once the insert is queued;
+#                                   queued rows are lost if the process is killed,
+#                                   and only this worker sees them before the flush.
+# Batches only form from requests one worker process handles at the same time,
+# so run gunicorn with threads (THREADS in the Dockerfile) when this is on. Each
+# worker has its own writer: async mode does not order writes to one session
+# that reach different workers.
+MESSAGE_WRITE_BEHIND = os.environ.get("MESSAGE_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_DURABILITY = os.environ.get("WRITE_BEHIND_DURABILITY", "commit")
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get("WRITE_BEHIND_MAX_BATCH", "256"))
+WRITE_BEHIND_MAX_DELAY_MS = float(os.environ.get("WRITE_BEHIND_MAX_DELAY_MS", "2"))
+# How long a request waits on the writer before failing instead of hanging.
+WRITE_BEHIND_WAIT_TIMEOUT_S = float(os.environ.get("WRITE_BEHIND_WAIT_TIMEOUT_S", "30"))
+
+_local = threading.local()
+
+# Per-process cache of get_settings_and_prompts(), keyed by settings_version.version.
+_settings_cache = {"version": None, "settings": None}
+_settings_cache_lock = threading.Lock()
+
+
+def _connect():
+    db = sqlite3.connect(DATABASE_NAME, detect_types=sqlite3.PARSE_DECLTYPES,
+                         cached_statements=STATEMENT_CACHE_SIZE)
     db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    for pragma, value in SQLITE_PRAGMAS.items():
+        db.execute(f"PRAGMA {pragma}={value}")
+    return db
+
+
+def get_db():
+    """
+    Returns this thread's pooled connection, opening it on first use.
+
+    Connections are kept per worker process and per thread, so prepared
+    statements stay cached between requests. The pid check makes sure a
+    connection inherited across a fork is never reused by the child.
+    """
+    db = getattr(_local, "db", None)
+    if db is None or _local.pid != os.getpid():
+        db = _connect()
+        _local.db = db
+        _local.pid = os.getpid()
     return db
 
 
@@ -37,13 +114,221 @@ def run_migrations(cursor):
     if 'ai_name' not in session_columns:
         print("Migrating sessions table: adding 'ai_name' column.")
         cursor.execute("ALTER TABLE sessions ADD COLUMN ai_name TEXT")
+    if 'revision' not in session_columns:
+        print("Migrating sessions table: adding 'revision' column.")
+        cursor.execute("ALTER TABLE sessions ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+    if 'history_epoch' not in session_columns:
+        # Bumped whenever messages are removed, so cached histories know a delta is not enough.
+        print("Migrating sessions table: adding 'history_epoch' column.")
+        cursor.execute("ALTER TABLE sessions ADD COLUMN history_epoch INTEGER NOT NULL DEFAULT 0")
+    if 'message_count' not in session_columns:
+        print("Migrating sessions table: adding summary columns.")
+        cursor.execute("ALTER TABLE sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("ALTER TABLE sessions ADD COLUMN last_activity_at TIMESTAMP")
+        cursor.execute("ALTER TABLE sessions ADD COLUMN last_message_preview TEXT")
+        # One-time backfill; from here on the triggers below keep these current.
+        cursor.execute(f"""
+                       UPDATE sessions
+                       SET message_count        = (SELECT COUNT(*)
+                                                   FROM messages m
+                                                   WHERE m.session_id = sessions.id
+                                                     AND m.role IN ('user', 'assistant')),
+                           last_activity_at     = COALESCE((SELECT MAX(m.timestamp)
+                                                            FROM messages m
+                                                            WHERE m.session_id = sessions.id
+                                                              AND m.role IN ('user', 'assistant')), created_at),
+                           last_message_preview = (SELECT substr(m.content, 1, {PREVIEW_LENGTH})
+                                                   FROM messages m
+                                                   WHERE m.session_id = sessions.id
+                                                     AND m.role IN ('user', 'assistant')
+                                                   ORDER BY m.timestamp DESC, m.id DESC
+                                                   LIMIT 1)
+                       """)
+
+    # --- Migration for 'messages' table ---
+    cursor.execute("PRAGMA table_info(messages)")
+    message_columns = [row['name'] for row in cursor.fetchall()]
+
+    if 'summary_from_id' not in message_columns:
+        # Summary rows (role 'summary') record the range of message ids they replace.
+        print("Migrating messages table: adding summary range columns.")
+        cursor.execute("ALTER TABLE messages ADD COLUMN summary_from_id INTEGER")
+        cursor.execute("ALTER TABLE messages ADD COLUMN summary_to_id INTEGER")
+    if 'token_count' not in message_columns:
+        # Counted once at insert so chat-service can budget context without re-tokenizing.
+        print("Migrating messages table: adding 'token_count' column.")
+        cursor.execute("ALTER TABLE messages ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0")
+        cursor.execute(f"UPDATE messages SET token_count = (length(content) + {CHARS_PER_TOKEN - 1}) / {CHARS_PER_TOKEN}")
+    if 'client_id' not in message_columns:
+        # Idempotency key chosen by the client, so a retried insert is stored once.
+        print("Migrating messages table: adding 'client_id' column.")
+        cursor.execute("ALTER TABLE messages ADD COLUMN client_id TEXT")
+
+    # --- Migration for 'settings_version' table ---
+    # Single-row counter bumped on every settings save. Workers compare it against
+    # their cached copy, which makes cross-worker cache invalidation one PK lookup.
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS settings_version
+                   (
+                       id      INTEGER PRIMARY KEY CHECK (id = 1),
+                       version INTEGER NOT NULL
+                   )
+                   """)
+    cursor.execute("INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 1)")
+
+    # --- Migration for 'messages' indexes ---
+    # History is always read per session in (timestamp, id) order; without this
+    # index every lookup scans the whole messages table.
+    cursor.execute("""
+                   CREATE INDEX IF NOT EXISTS idx_messages_session_timestamp
+                       ON messages (session_id, timestamp, id)
+                   """)
+    cursor.execute("""
+                   CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_id
+                       ON messages (client_id) WHERE client_id IS NOT NULL
+                   """)
+
+    # --- Migration for 'archived_sessions' table ---
+    # Cold storage: the whole transcript of an idle session as one compressed blob.
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS archived_sessions
+                   (
+                       session_id       TEXT PRIMARY KEY REFERENCES sessions (id) ON DELETE CASCADE,
+                       codec            TEXT      NOT NULL,
+                       transcript       BLOB      NOT NULL,
+                       message_count    INTEGER   NOT NULL,
+                       raw_bytes        INTEGER   NOT NULL,
+                       compressed_bytes INTEGER   NOT NULL,
+                       archived_at      TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                   )
+                   """)
+
+    # --- Migration for 'stream_checkpoints' table ---
+    # Partial text of replies chat-service is still streaming, saved periodically so
+    # it survives a chat-service restart. Replaced by the real message when the
+    # reply is stored (see add_message).
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS stream_checkpoints
+                   (
+                       stream_id  TEXT PRIMARY KEY,
+                       session_id TEXT      NOT NULL REFERENCES sessions (id) ON DELETE CASCADE,
+                       content    TEXT      NOT NULL,
+                       updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                   )
+                   """)
+    cursor.execute("""
+                   CREATE INDEX IF NOT EXISTS idx_stream_checkpoints_session
+                       ON stream_checkpoints (session_id, updated_at)
+                   """)
+
+    # --- Migration for outdated triggers ---
+    # Triggers written before summary rows existed only skipped system prompts;
+    # drop them so they are recreated below to skip summaries as well.
+    outdated_triggers = cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND sql LIKE '%role != ''system''%'").fetchall()
+    for row in outdated_triggers:
+        print(f"Migrating triggers: recreating '{row['name']}'.")
+        cursor.execute(f"DROP TRIGGER {row['name']}")
+
+    # --- Migration for session summary triggers and listing index ---
+    # The covering index lets the sidebar page through sessions by recent activity
+    # without touching the table or grouping over messages.
+    cursor.execute("""
+                   CREATE INDEX IF NOT EXISTS idx_sessions_activity
+                       ON sessions (last_activity_at, id, title, icon, message_count, last_message_preview)
+                   """)
+    cursor.execute(f"""
+                   CREATE TRIGGER IF NOT EXISTS sessions_summary_insert AFTER INSERT ON messages
+                       WHEN new.role IN ('user', 'assistant')
+                   BEGIN
+                       UPDATE sessions
+                       SET message_count        = message_count + 1,
+                           last_activity_at     = new.timestamp,
+                           last_message_preview = substr(new.content, 1, {PREVIEW_LENGTH})
+                       WHERE id = new.session_id;
+                   END
+                   """)
+    cursor.execute(f"""
+                   CREATE TRIGGER IF NOT EXISTS sessions_summary_delete AFTER DELETE ON messages
+                       WHEN old.role IN ('user', 'assistant')
+                   BEGIN
+                       UPDATE sessions
+                       SET message_count        = message_count - 1,
+                           last_message_preview = (SELECT substr(m.content, 1, {PREVIEW_LENGTH})
+                                                   FROM messages m
+                                                   WHERE m.session_id = old.session_id
+                                                     AND m.role IN ('user', 'assistant')
+                                                   ORDER BY m.timestamp DESC, m.id DESC
+                                                   LIMIT 1)
+                       WHERE id = old.session_id;
+                   END
+                   """)
+
+    # --- Migration for 'messages_fts' full-text index ---
+    # External-content FTS5 index over user/assistant messages (system prompts and
+    # summaries are skipped), kept in sync by triggers and backfilled once when first created.
+    fts_exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+    if not fts_exists:
+        print("Migrating messages: creating 'messages_fts' search index.")
+        cursor.execute("""
+                       CREATE VIRTUAL TABLE messages_fts USING fts5
+                       (
+                           content,
+                           content = 'messages',
+                           content_rowid = 'id',
+                           tokenize = 'unicode61 remove_diacritics 2'
+                       )
+                       """)
+        cursor.execute("""
+                       INSERT INTO messages_fts (rowid, content)
+                       SELECT id, content FROM messages WHERE role IN ('user', 'assistant')
+                       """)
+    cursor.execute("""
+                   CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+                       WHEN new.role IN ('user', 'assistant')
+                   BEGIN
+                       INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+                   END
+                   """)
+    cursor.execute("""
+                   CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+                       WHEN old.role IN ('user', 'assistant')
+                   BEGIN
+                       INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                   END
+                   """)
+    cursor.execute("""
+                   CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, role ON messages
+                   BEGIN
+                       INSERT INTO messages_fts (messages_fts, rowid, content)
+                       SELECT 'delete', old.id, old.content WHERE old.role IN ('user', 'assistant');
+                       INSERT INTO messages_fts (rowid, content)
+                       SELECT new.id, new.content WHERE new.role IN ('user', 'assistant');
+                   END
+                   """)
 
 
 def init_db():
-    """Initializes the database with the required tables and runs migrations."""
+    """
+    Initializes the database with the required tables and runs migrations.
+
+    Every worker process runs this at startup. The whole schema check runs in one
+    write transaction, so workers starting together take turns and each one sees
+    the columns and tables the previous one added.
+    """
     db = get_db()
-    cursor = db.cursor()
+    db.execute(f"PRAGMA busy_timeout={MIGRATION_BUSY_TIMEOUT_MS}")
+    try:
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            create_schema(db.cursor())
+    finally:
+        db.execute(f"PRAGMA busy_timeout={SQLITE_PRAGMAS['busy_timeout']}")
+
 
+def create_schema(cursor):
+    """Creates missing tables and migrates existing ones; init_db runs it under a write lock."""
     cursor.execute("""
                    CREATE TABLE IF NOT EXISTS settings
                    (
@@ -146,117 +431,699 @@ def init_db():
     # Run schema migrations to update existing databases
     run_migrations(cursor)
 
-    db.commit()
-    db.close()
+
+def estimate_tokens(text):
+    """
+    Cheap, model-independent token estimate (about CHARS_PER_TOKEN characters per
+    token). Must stay in sync with the backfill expression in run_migrations.
+    Anything but a string (a missing content, say) counts as no tokens.
+    """
+    if not isinstance(text, str):
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
 
 
 # --- Settings and Prompts Functions ---
+def get_settings_version():
+    db = get_db()
+    return db.execute("SELECT version FROM settings_version WHERE id = 1").fetchone()['version']
+
+
 def get_settings_and_prompts():
+    """Returns the cached settings dict; callers must treat it as read-only."""
+    return get_versioned_settings_and_prompts()[1]
+
+
+def get_versioned_settings_and_prompts():
+    """
+    Returns (version, settings). Settings are only re-read from the database
+    when another worker (or this one) has bumped the settings version.
+    """
     db = get_db()
-    settings_rows = db.execute("SELECT key, value FROM settings").fetchall()
-    prompts_rows = db.execute("SELECT title, prompt, icon, ai_name FROM prompts ORDER BY id").fetchall()
-    db.close()
+    with db:
+        # Read the version and the rows from one snapshot so they always match.
+        db.execute("BEGIN")
+        version = db.execute("SELECT version FROM settings_version WHERE id = 1").fetchone()['version']
+        with _settings_cache_lock:
+            if _settings_cache["version"] == version:
+                return version, _settings_cache["settings"]
+
+        settings_rows = db.execute("SELECT key, value FROM settings").fetchall()
+        prompts_rows = db.execute("SELECT title, prompt, icon, ai_name FROM prompts ORDER BY id").fetchall()
 
     settings = {row['key']: row['value'] for row in settings_rows}
     prompts = [{"title": row['title'], "prompt": row['prompt'], "icon": row['icon'], "ai_name": row['ai_name']} for row
                in prompts_rows]
     settings['prompts'] = prompts
-    return settings
+    with _settings_cache_lock:
+        _settings_cache["version"] = version
+        _settings_cache["settings"] = settings
+    return version, settings
 
 
 def save_settings_and_prompts(settings_data):
     db = get_db()
-    cursor = db.cursor()
+    with db:
+        cursor = db.cursor()
 
-    prompts = settings_data.pop('prompts', [])
-    cursor.execute("DELETE FROM prompts")
-    if prompts:
-        prompt_data = [(p['title'], p['prompt'], p.get('icon', 'bot.svg'), p.get('ai_name')) for p in prompts]
-        cursor.executemany(
-            "INSERT INTO prompts (title, prompt, icon, ai_name) VALUES (?, ?, ?, ?)",
-            prompt_data
-        )
+        prompts = settings_data.pop('prompts', [])
+        cursor.execute("DELETE FROM prompts")
+        if prompts:
+            prompt_data = [(p['title'], p['prompt'], p.get('icon', 'bot.svg'), p.get('ai_name')) for p in prompts]
+            cursor.executemany(
+                "INSERT INTO prompts (title, prompt, icon, ai_name) VALUES (?, ?, ?, ?)",
+                prompt_data
+            )
 
-    for key, value in settings_data.items():
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+        for key, value in settings_data.items():
+            cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
 
-    db.commit()
-    db.close()
+        cursor.execute("UPDATE settings_version SET version = version + 1 WHERE id = 1")
 
 
 # --- Session and Message Functions ---
+def _session_summary(row):
+    return {"id": row['id'], "title": row['title'], "icon": row['icon'], "message_count": row['message_count'],
+            "last_activity_at": str(row['last_activity_at']), "last_message_preview": row['last_message_preview']}
+
+
 def get_all_sessions():
     db = get_db()
-    sessions = db.execute("SELECT id, title, icon FROM sessions ORDER BY created_at DESC").fetchall()
-    db.close()
-    return [dict(row) for row in sessions]
+    sessions = db.execute("SELECT id, title, icon, message_count, last_activity_at, last_message_preview "
+                          "FROM sessions ORDER BY last_activity_at DESC, id DESC").fetchall()
+    return [_session_summary(row) for row in sessions]
+
+
+def get_sessions_page(cursor=None, limit=50):
+    """
+    Returns one page of sessions, most recently active first.
+
+    `cursor` is the (last_activity_at, id) pair of the last session on the previous
+    page. Returns (sessions, next_cursor); next_cursor is None on the last page.
+    """
+    db = get_db()
+    if cursor is None:
+        rows = db.execute("SELECT id, title, icon, message_count, last_activity_at, last_message_preview "
+                          "FROM sessions ORDER BY last_activity_at DESC, id DESC LIMIT ?",
+                          (limit + 1,)).fetchall()
+    else:
+        rows = db.execute("SELECT id, title, icon, message_count, last_activity_at, last_message_preview "
+                          "FROM sessions WHERE (last_activity_at, id) < (?, ?) "
+                          "ORDER BY last_activity_at DESC, id DESC LIMIT ?",
+                          (cursor[0], cursor[1], limit + 1)).fetchall()
+
+    sessions = [_session_summary(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = (sessions[-1]['last_activity_at'], sessions[-1]['id'])
+    return sessions, next_cursor
 
 
 def get_session_info(session_id):
+    _wait_for_pending_writes(session_id)
     db = get_db()
-    session = db.execute("SELECT icon, ai_name FROM sessions WHERE id = ?", (session_id,)).fetchone()
-    db.close()
+    session = db.execute("SELECT icon, ai_name, revision FROM sessions WHERE id = ?", (session_id,)).fetchone()
     return dict(session) if session else None
 
 
+def get_session_revision(session_id):
+    """Returns the session's revision counter, or None if the session does not exist."""
+    _wait_for_pending_writes(session_id)
+    db = get_db()
+    row = db.execute("SELECT revision FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    return row['revision'] if row else None
+
+
+def get_session_with_messages(session_id):
+    """
+    Fetches a session's info and full transcript with a single joined query.
+    Returns None if the session does not exist.
+    """
+    _wait_for_pending_writes(session_id)
+    db = get_db()
+    rows = db.execute("""
+                      SELECT s.icon, s.ai_name, s.revision, m.role, m.content
+                      FROM sessions s
+                               LEFT JOIN messages m ON m.session_id = s.id AND m.role != 'summary'
+                      WHERE s.id = ?
+                      ORDER BY m.timestamp ASC, m.id ASC
+                      """, (session_id,)).fetchall()
+    if not rows:
+        return None
+    first = rows[0]
+    if first['role'] is None:
+        # No hot rows: the session is either empty or archived.
+        rows = _load_archived_messages(db, session_id) or []
+    messages = [{"role": row['role'], "content": row['content']} for row in rows
+                if row['role'] is not None and row['role'] != 'summary']
+    return {"icon": first['icon'], "ai_name": first['ai_name'], "revision": first['revision'], "messages": messages}
+
+
+def _fetch_session_rows(db, session_id):
+    rows = db.execute("SELECT id, role, content, token_count, summary_from_id, summary_to_id "
+                      "FROM messages WHERE session_id = ? ORDER BY timestamp ASC, id ASC",
+                      (session_id,)).fetchall()
+    if not rows:
+        rows = _load_archived_messages(db, session_id) or []
+    return rows
+
+
+def _fetch_session_messages(db, session_id):
+    """The visible transcript: every message except compaction summaries."""
+    return [{"role": row['role'], "content": row['content']} for row in _fetch_session_rows(db, session_id)
+            if row['role'] != 'summary']
+
+
+def _fetch_history_delta(db, session_id, after_id=None, epoch=None):
+    """
+    Returns the messages a client holding history up to `after_id` (at `epoch`) is
+    missing, each with its stored token count. If the client has nothing cached, or messages were removed since its
+    epoch, the full history is returned with reset=True instead.
+    """
+    row = db.execute("SELECT history_epoch FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    current_epoch = row['history_epoch'] if row else None
+    reset = after_id is None or current_epoch is None or epoch != current_epoch
+    if reset:
+        rows = _fetch_session_rows(db, session_id)
+    else:
+        rows = db.execute("SELECT id, role, content, token_count, summary_from_id, summary_to_id "
+                          "FROM messages WHERE session_id = ? "
+                          "AND (timestamp, id) > (SELECT timestamp, id FROM messages WHERE id = ?) "
+                          "ORDER BY timestamp ASC, id ASC",
+                          (session_id, after_id)).fetchall()
+    last_id = rows[-1]['id'] if rows else (None if reset else after_id)
+    return {"messages": [_history_message(r) for r in rows], "last_id": last_id, "epoch": current_epoch,
+            "reset": reset}
+
+
+def _history_message(row):
+    message = {"id": row['id'], "role": row['role'], "content": row['content'], "tokens": row['token_count']}
+    if row['role'] == 'summary':
+        message["summary_from_id"] = row['summary_from_id']
+        message["summary_to_id"] = row['summary_to_id']
+    return message
+
+
+def get_session_messages_since(session_id, after_id=None, epoch=None):
+    _wait_for_pending_writes(session_id)
+    return _fetch_history_delta(get_db(), session_id, after_id, epoch)
+
+
 def get_session_messages(session_id):
+    _wait_for_pending_writes(session_id)
+    return _fetch_session_messages(get_db(), session_id)
+
+
+def get_session_messages_page(session_id, before_id=None, limit=50):
+    """
+    Returns one page of a session's history, oldest first, using keyset pagination.
+
+    The page holds the newest `limit` messages older than `before_id` (or the newest
+    messages overall when `before_id` is None). Returns (messages, next_before_id),
+    where next_before_id is the cursor for the previous page, or None when the start
+    of the transcript has been reached.
+    """
+    _wait_for_pending_writes(session_id)
+    db = get_db()
+    if before_id is None:
+        rows = db.execute("SELECT id, role, content FROM messages WHERE session_id = ? AND role != 'summary' "
+                          "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                          (session_id, limit + 1)).fetchall()
+    else:
+        rows = db.execute("SELECT id, role, content FROM messages WHERE session_id = ? AND role != 'summary' "
+                          "AND (timestamp, id) < (SELECT timestamp, id FROM messages WHERE id = ?) "
+                          "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                          (session_id, before_id, limit + 1)).fetchall()
+
+    if not rows:
+        archived = [row for row in _load_archived_messages(db, session_id) or [] if row['role'] != 'summary']
+        if archived:
+            if before_id is not None:
+                archived = [row for row in archived if row['id'] < before_id]
+            rows = archived[::-1][:limit + 1]
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_before_id = rows[-1]['id'] if has_more else None
+    messages = [{"role": row['role'], "content": row['content']} for row in reversed(rows)]
+    return messages, next_before_id
+
+
+def _fts_query(text):
+    """Turns free text into an FTS5 query that ANDs each term as a literal phrase."""
+    terms = text.split()
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _highlight(snippet):
+    """Escapes a snippet's message text for HTML and turns its match markers into <mark> tags."""
+    return html.escape(snippet).replace(SNIPPET_MARK_START, "<mark>").replace(SNIPPET_MARK_END, "</mark>")
+
+
+def search_messages(query, limit=20, offset=0):
+    """
+    Full-text search over user and assistant messages, best bm25 match first.
+    Returns (results, has_more); each result carries a snippet of HTML-escaped
+    message text with the matches in <mark> tags. Archived sessions are not
+    searched (see ARCHIVE_IDLE_DAYS).
+    """
+    match = _fts_query(query)
+    if not match:
+        return [], False
     db = get_db()
-    messages = db.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY timestamp ASC",
-                          (session_id,)).fetchall()
-    db.close()
-    return [dict(row) for row in messages]
+    rows = db.execute("""
+                      SELECT m.id,
+                             m.session_id,
+                             s.title,
+                             m.role,
+                             m.timestamp,
+                             snippet(messages_fts, 0, ?, ?, '…', 16) AS snippet
+                      FROM messages_fts
+                               JOIN messages m ON m.id = messages_fts.rowid
+                               JOIN sessions s ON s.id = m.session_id
+                      WHERE messages_fts MATCH ?
+                      ORDER BY messages_fts.rank
+                      LIMIT ? OFFSET ?
+                      """, (SNIPPET_MARK_START, SNIPPET_MARK_END, match, limit + 1, offset)).fetchall()
+    results = [{"message_id": row['id'], "session_id": row['session_id'], "title": row['title'],
+                "role": row['role'], "timestamp": str(row['timestamp']), "snippet": _highlight(row['snippet'])}
+               for row in rows[:limit]]
+    return results, len(rows) > limit
 
 
 def create_session(session_id, title, system_prompt, icon='bot.svg', ai_name=None):
     db = get_db()
-    db.execute("INSERT INTO sessions (id, title, icon, ai_name) VALUES (?, ?, ?, ?)",
-               (session_id, title, icon, ai_name))
-    db.execute("INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
-               (session_id, 'system', system_prompt))
-    db.commit()
-    db.close()
+    with db:
+        db.execute("INSERT INTO sessions (id, title, icon, ai_name, last_activity_at) "
+                   "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                   (session_id, title, icon, ai_name))
+        db.execute("INSERT INTO messages (session_id, role, content, token_count) VALUES (?, ?, ?, ?)",
+                   (session_id, 'system', system_prompt, estimate_tokens(system_prompt)))
+
+
+def _insert_messages(db, rows):
+    """
+    Inserts (session_id, role, content, client_id) rows; the caller owns the
+    transaction. A row whose client_id is already stored is skipped.
+    """
+    _promote_archived_sessions(db, {row[0] for row in rows})
+    db.executemany("INSERT INTO messages (session_id, role, content, token_count, client_id) VALUES (?, ?, ?, ?, ?) "
+                   "ON CONFLICT (client_id) WHERE client_id IS NOT NULL DO NOTHING",
+                   [(session_id, role, content, estimate_tokens(content), client_id)
+                    for session_id, role, content, client_id in rows])
+    db.executemany("UPDATE sessions SET revision = revision + 1 WHERE id = ?", [(row[0],) for row in rows])
+
+
+def add_message(session_id, role, content, stream_id=None, client_id=None):
+    """
+    Appends a message. A `stream_id` marks the final text of a checkpointed reply:
+    the message and the checkpoint's removal are committed together, bypassing
+    write-behind mode. A message with the `client_id` of a stored one is dropped,
+    which makes retrying the same insert safe.
+    """
+    if stream_id:
+        _wait_for_pending_writes(session_id)
+        db = get_db()
+        with db:
+            # Only the side that removes the checkpoint stores the reply: if
+            # _promote_stream_checkpoints got there first, its copy stays the only one.
+            removed = db.execute("DELETE FROM stream_checkpoints WHERE stream_id = ?", (stream_id,)).rowcount
+            if removed or not db.execute("SELECT 1 FROM messages WHERE client_id = ?", (stream_id,)).fetchone():
+                _insert_messages(db, [(session_id, role, content, client_id)])
+        return
+    if MESSAGE_WRITE_BEHIND:
+        _get_message_writer().submit(session_id, role, content, client_id,
+                                     wait=WRITE_BEHIND_DURABILITY != "async")
+        return
+    db = get_db()
+    with db:
+        _insert_messages(db, [(session_id, role, content, client_id)])
 
 
-def add_message(session_id, role, content):
+def add_message_and_fetch(session_id, role, content, after_id=None, epoch=None, title=None):
+    """
+    Appends a message and returns the history delta since `after_id`, new message
+    included, in one transaction (see _fetch_history_delta). If `title` is given it
+    becomes the session title when this is the session's first message. Always
+    commits directly, even in write-behind mode.
+    """
+    _wait_for_pending_writes(session_id)
     db = get_db()
-    db.execute("INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)", (session_id, role, content))
-    db.commit()
-    db.close()
+    with db:
+        _promote_stream_checkpoints(db, session_id)
+        if title:
+            db.execute("UPDATE sessions SET title = ?, revision = revision + 1 WHERE id = ? AND message_count = 0",
+                       (title, session_id))
+        _insert_messages(db, [(session_id, role, content, None)])
+        return _fetch_history_delta(db, session_id, after_id, epoch)
+
+
+def add_summary(session_id, content, from_id, to_id):
+    """
+    Stores a compaction summary replacing messages from_id..to_id in the LLM context.
+    Summary rows stay out of the visible transcript, search and session counts.
+    """
+    _wait_for_pending_writes(session_id)
+    db = get_db()
+    with db:
+        _promote_archived_sessions(db, {session_id})
+        db.execute("INSERT INTO messages (session_id, role, content, token_count, summary_from_id, summary_to_id) "
+                   "VALUES (?, 'summary', ?, ?, ?, ?)",
+                   (session_id, content, estimate_tokens(content), from_id, to_id))
+
+
+# --- Stream Checkpoints ---
+def save_stream_checkpoint(session_id, stream_id, content):
+    db = get_db()
+    with db:
+        db.execute("INSERT INTO stream_checkpoints (stream_id, session_id, content) VALUES (?, ?, ?) "
+                   "ON CONFLICT (stream_id) DO UPDATE SET content = excluded.content, updated_at = CURRENT_TIMESTAMP",
+                   (stream_id, session_id, content))
+
+
+def get_stream_checkpoint(session_id, stream_id):
+    db = get_db()
+    row = db.execute("SELECT content, updated_at FROM stream_checkpoints WHERE stream_id = ? AND session_id = ?",
+                     (stream_id, session_id)).fetchone()
+    return {"content": row['content'], "updated_at": str(row['updated_at'])} if row else None
+
+
+def _promote_stream_checkpoints(db, session_id):
+    """
+    Stores checkpoints whose stream never finished (chat-service went away mid-reply)
+    as assistant messages, so the partial reply stays in the history before anything
+    newer is written. Each is stored with its stream_id as client_id, which tells a
+    late final save of the same stream (see add_message) that it was promoted. The
+    caller owns the transaction.
+    """
+    # Deleted first, so only checkpoints this transaction removed are stored.
+    rows = db.execute("DELETE FROM stream_checkpoints WHERE session_id = ? "
+                      "RETURNING stream_id, content, updated_at", (session_id,)).fetchall()
+    if not rows:
+        return
+    rows.sort(key=lambda row: row['updated_at'])
+    _insert_messages(db, [(session_id, 'assistant', row['content'], row['stream_id']) for row in rows])
+
+
+# --- Write-Behind Message Writer ---
+class _PendingWrite:
+    __slots__ = ("session_id", "role", "content", "client_id", "done", "error")
+
+    def __init__(self, session_id, role, content, client_id=None):
+        self.session_id = session_id
+        self.role = role
+        self.content = content
+        self.client_id = client_id
+        self.done = threading.Event()
+        self.error = None
+
+
+class MessageWriter:
+    """
+    Owns a bounded queue of message inserts and a single thread that commits
+    them in batches. A batch is flushed once it holds max_batch rows or once
+    max_delay seconds have passed since its first row was queued.
+    """
+    _STOP = object()
+
+    def __init__(self, max_batch=WRITE_BEHIND_MAX_BATCH, max_delay=WRITE_BEHIND_MAX_DELAY_MS / 1000,
+                 queue_size=WRITE_BEHIND_QUEUE_SIZE, wait_timeout=WRITE_BEHIND_WAIT_TIMEOUT_S):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.wait_timeout = wait_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Last queued write per session, used to give readers read-your-writes.
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, session_id, role, content, client_id=None, wait=True):
+        item = _PendingWrite(session_id, role, content, client_id)
+        with self.lock:
+            self.pending[session_id] = item
+        # Blocks when the queue is full, pushing back on callers instead of growing memory.
+        try:
+            self.queue.put(item, timeout=self.wait_timeout)
+        except queue.Full:
+            raise TimeoutError("message writer queue is full") from None
+        if wait:
+            self._wait(item)
+            if item.error:
+                raise item.error
+
+    def wait_for_session(self, session_id):
+        """Blocks until every write queued so far for session_id is committed."""
+        with self.lock:
+            item = self.pending.get(session_id)
+        if item is not None:
+            self._wait(item)
+
+    def _wait(self, item):
+        if not item.done.wait(self.wait_timeout):
+            raise TimeoutError(f"message writer did not commit within {self.wait_timeout} s")
+
+    def stop(self):
+        """Flushes everything still queued and stops the writer thread."""
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        # Any error is handed to the waiting callers; the writer thread itself must survive it.
+        try:
+            db = get_db()
+            try:
+                with db:
+                    _insert_messages(db, [(i.session_id, i.role, i.content, i.client_id) for i in batch])
+            except Exception:
+                # Retry row by row so one bad insert does not fail the whole batch.
+                for i in batch:
+                    try:
+                        with db:
+                            _insert_messages(db, [(i.session_id, i.role, i.content, i.client_id)])
+                    except Exception as e:
+                        print(f"Write-behind insert failed for session {i.session_id}: {e}")
+                        i.error = e
+        except Exception as e:
+            print(f"Write-behind batch failed: {e}")
+            for i in batch:
+                i.error = i.error or e
+        finally:
+            with self.lock:
+                for i in batch:
+                    if self.pending.get(i.session_id) is i:
+                        del self.pending[i.session_id]
+            for i in batch:
+                i.done.set()
+
+
+_message_writer = None
+_message_writer_pid = None
+_message_writer_lock = threading.Lock()
+
+
+def _get_message_writer():
+    global _message_writer, _message_writer_pid
+    with _message_writer_lock:
+        if _message_writer is None or _message_writer_pid != os.getpid():
+            _message_writer = MessageWriter()
+            _message_writer_pid = os.getpid()
+        return _message_writer
+
+
+def _wait_for_pending_writes(session_id):
+    writer = _message_writer
+    if writer is not None and _message_writer_pid == os.getpid():
+        writer.wait_for_session(session_id)
+
+
+def flush_message_writer():
+    """Shutdown hook: commits every queued message and stops the writer thread."""
+    global _message_writer
+    with _message_writer_lock:
+        writer = _message_writer
+        _message_writer = None
+    if writer is not None and _message_writer_pid == os.getpid():
+        writer.stop()
+
+
+atexit.register(flush_message_writer)
 
 
 def delete_session(session_id):
+    _wait_for_pending_writes(session_id)
     db = get_db()
-    db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
-    db.commit()
-    db.close()
+    with db:
+        db.execute("DELETE FROM archived_sessions WHERE session_id = ?", (session_id,))
+        db.execute("DELETE FROM stream_checkpoints WHERE session_id = ?", (session_id,))
+        db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
 
 
 def rename_session(session_id, new_title):
     db = get_db()
-    db.execute("UPDATE sessions SET title = ? WHERE id = ?", (new_title, session_id))
-    db.commit()
-    db.close()
+    with db:
+        db.execute("UPDATE sessions SET title = ?, revision = revision + 1 WHERE id = ?", (new_title, session_id))
 
 
-def delete_last_assistant_message(session_id):
-    db = get_db()
-    cursor = db.cursor()
-    last_message_id_row = cursor.execute(
+def _delete_last_assistant_message(db, session_id):
+    """Deletes the newest assistant message; the caller owns the transaction."""
+    _promote_archived_sessions(db, {session_id})
+    _promote_stream_checkpoints(db, session_id)
+    last_message_id_row = db.execute(
         "SELECT id FROM messages WHERE session_id = ? AND role = 'assistant' ORDER BY timestamp DESC, id DESC LIMIT 1",
         (session_id,)).fetchone()
-    if last_message_id_row:
-        cursor.execute("DELETE FROM messages WHERE id = ?", (last_message_id_row['id'],))
-        db.commit()
-        db.close()
-        return True
-    db.close()
-    return False
+    if not last_message_id_row:
+        return False
+    db.execute("DELETE FROM messages WHERE id = ?", (last_message_id_row['id'],))
+    db.execute("UPDATE sessions SET revision = revision + 1, history_epoch = history_epoch + 1 WHERE id = ?",
+               (session_id,))
+    return True
+
+
+def delete_last_assistant_message(session_id):
+    _wait_for_pending_writes(session_id)
+    db = get_db()
+    with db:
+        return _delete_last_assistant_message(db, session_id)
+
+
+def delete_last_assistant_message_and_fetch(session_id):
+    """
+    Deletes the last assistant message and returns (deleted, history) from the
+    same transaction. The history is a full reset in the _fetch_history_delta format.
+    """
+    _wait_for_pending_writes(session_id)
+    db = get_db()
+    with db:
+        deleted = _delete_last_assistant_message(db, session_id)
+        return deleted, _fetch_history_delta(db, session_id)
+
+
+# --- Cold Session Archive ---
+def _load_archived_messages(db, session_id):
+    """Decompresses an archived transcript into message dicts (id, role, content, timestamp), or None."""
+    row = db.execute("SELECT codec, transcript FROM archived_sessions WHERE session_id = ?",
+                     (session_id,)).fetchone()
+    if row is None:
+        return None
+    rows = json.loads(zlib.decompress(row['transcript']))
+    return [{"id": r[0], "role": r[1], "content": r[2], "timestamp": r[3], "token_count": estimate_tokens(r[2]),
+             "summary_from_id": r[4] if len(r) > 4 else None, "summary_to_id": r[5] if len(r) > 5 else None}
+            for r in rows]
+
+
+def _restore_session_summary(db, session_id, summary):
+    """Rewrites the trigger-maintained summary, which archiving must not change."""
+    db.execute("UPDATE sessions SET message_count = ?, last_activity_at = ?, last_message_preview = ? WHERE id = ?",
+               (summary['message_count'], summary['last_activity_at'], summary['last_message_preview'], session_id))
+
+
+def _promote_archived_sessions(db, session_ids):
+    """Moves archived sessions back into the hot messages table; the caller owns the transaction."""
+    placeholders = ",".join("?" * len(session_ids))
+    archived = db.execute(f"SELECT session_id FROM archived_sessions WHERE session_id IN ({placeholders})",
+                          list(session_ids)).fetchall()
+    for row in archived:
+        session_id = row['session_id']
+        summary = db.execute("SELECT message_count, last_activity_at, last_message_preview FROM sessions WHERE id = ?",
+                             (session_id,)).fetchone()
+        messages = _load_archived_messages(db, session_id)
+        db.executemany("INSERT INTO messages "
+                       "(id, session_id, role, content, timestamp, token_count, summary_from_id, summary_to_id) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(m['id'], session_id, m['role'], m['content'], m['timestamp'], m['token_count'],
+                         m['summary_from_id'], m['summary_to_id']) for m in messages])
+        db.execute("DELETE FROM archived_sessions WHERE session_id = ?", (session_id,))
+        if summary:
+            _restore_session_summary(db, session_id, summary)
+
+
+def archive_session(session_id):
+    """
+    Moves one session's messages into a compressed blob in archived_sessions.
+    Returns (raw_bytes, compressed_bytes), or None if there was nothing to archive.
+    """
+    db = get_db()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        summary = db.execute("SELECT message_count, last_activity_at, last_message_preview FROM sessions WHERE id = ?",
+                             (session_id,)).fetchone()
+        rows = db.execute("SELECT id, role, content, timestamp, summary_from_id, summary_to_id FROM messages "
+                          "WHERE session_id = ? ORDER BY timestamp ASC, id ASC", (session_id,)).fetchall()
+        if summary is None or not rows:
+            return None
+
+        raw = json.dumps([[r['id'], r['role'], r['content'], str(r['timestamp']), r['summary_from_id'],
+                           r['summary_to_id']] for r in rows]).encode()
+        compressed = zlib.compress(raw, ARCHIVE_COMPRESSION_LEVEL)
+        db.execute("INSERT INTO archived_sessions "
+                   "(session_id, codec, transcript, message_count, raw_bytes, compressed_bytes) "
+                   "VALUES (?, 'zlib', ?, ?, ?, ?)",
+                   (session_id, compressed, len(rows), len(raw), len(compressed)))
+        db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        _restore_session_summary(db, session_id, summary)
+    return len(raw), len(compressed)
+
+
+def archive_idle_sessions(idle_days=ARCHIVE_IDLE_DAYS, limit=None):
+    """
+    Archives every hot session with no activity for `idle_days`.
+    Returns a summary of this run: sessions archived and bytes before/after compression.
+    """
+    db = get_db()
+    query = ("SELECT id FROM sessions WHERE last_activity_at < datetime('now', ?) "
+             "AND id NOT IN (SELECT session_id FROM archived_sessions) ORDER BY last_activity_at")
+    params = [f"-{idle_days} days"]
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    session_ids = [row['id'] for row in db.execute(query, params).fetchall()]
+
+    stats = {"sessions_archived": 0, "raw_bytes": 0, "compressed_bytes": 0}
+    for session_id in session_ids:
+        _wait_for_pending_writes(session_id)
+        result = archive_session(session_id)
+        if result:
+            stats["sessions_archived"] += 1
+            stats["raw_bytes"] += result[0]
+            stats["compressed_bytes"] += result[1]
+    stats["bytes_saved"] = stats["raw_bytes"] - stats["compressed_bytes"]
+    return stats
+
+
+def get_archive_stats():
+    """Totals across everything currently in cold storage."""
+    db = get_db()
+    row = db.execute("SELECT COUNT(*) AS sessions, COALESCE(SUM(message_count), 0) AS messages, "
+                     "COALESCE(SUM(raw_bytes), 0) AS raw_bytes, COALESCE(SUM(compressed_bytes), 0) AS compressed_bytes "
+                     "FROM archived_sessions").fetchone()
+    return {"archived_sessions": row['sessions'], "archived_messages": row['messages'],
+            "raw_bytes": row['raw_bytes'], "compressed_bytes": row['compressed_bytes'],
+            "bytes_saved": row['raw_bytes'] - row['compressed_bytes']}
 
 
 def migrate_from_json(default_settings):
     db = get_db()
     count = db.execute("SELECT COUNT(*) FROM settings").fetchone()[0]
-    db.close()
     if count == 0:
         print("No database found. Populating with default settings.")
         save_settings_and_prompts(default_settings)
\ No newline at end of file
@@ -1,7 +1,13 @@
 # File: services/core-services/app/main.py
 
 import os
-from flask import Flask, jsonify, request
+import json
+import gzip
+import base64
+import click
+import orjson
+import msgpack
+from flask import Flask, jsonify, request, Response, abort
 from pathlib import Path
 import database as db
 
@@ -42,20 +48,192 @@ except Exception as e:
     raise
 
 
+# --- Pagination ---
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def get_page_args():
+    """
+    Reads keyset pagination arguments (?before_id=&limit=) from the query string.
+    Returns None when the client did not ask for a page, so callers can fall back
+    to returning the full transcript.
+    """
+    if 'before_id' not in request.args and 'limit' not in request.args:
+        return None
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return before_id, max(1, min(limit, MAX_PAGE_SIZE))
+
+
+# --- Settings Responses ---
+# (version, serialized body) of the settings this worker last served.
+_settings_body = (None, None)
+
+
+def settings_response():
+    """
+    Serves settings with an ETag derived from the settings version. Clients that
+    send a matching If-None-Match get a 304 without the settings being re-read
+    or re-serialized.
+    """
+    global _settings_body
+    version = db.get_settings_version()
+    etag = f"settings-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    cached_version, body = _settings_body
+    if cached_version != version:
+        version, settings = db.get_versioned_settings_and_prompts()
+        etag = f"settings-{version}"
+        body = json.dumps(settings)
+        _settings_body = (version, body)
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+def session_etag(session_id, revision, page_args=None):
+    etag = f"{session_id}-{revision}"
+    if page_args is not None:
+        etag += "-{}-{}".format(*page_args)
+    return etag
+
+
+# --- Internal Wire Format ---
+# Internal routes answer in MessagePack when the client accepts it and in JSON
+# otherwise, and read request bodies in either. Bodies of at least
+# INTERNAL_COMPRESS_MIN_BYTES are gzipped for clients that accept it; 0 (the
+# default) turns this off, as between containers on one host compressing a
+# transcript costs more time than sending it.
+MSGPACK_MIMETYPE = "application/msgpack"
+INTERNAL_COMPRESS_MIN_BYTES = int(os.environ.get("INTERNAL_COMPRESS_MIN_BYTES", "0"))
+INTERNAL_COMPRESS_LEVEL = 1
+
+
+def internal_request_data():
+    """Decodes the MessagePack or JSON object body of an internal request; an empty body reads as {}."""
+    body = request.get_data()
+    if not body:
+        return {}
+    try:
+        if request.mimetype == MSGPACK_MIMETYPE:
+            data = msgpack.unpackb(body)
+        else:
+            data = orjson.loads(body)
+    except ValueError as e:
+        abort(400, f"Malformed request body: {e}")
+    if not isinstance(data, dict):
+        abort(400, "Request body must be an object.")
+    return data
+
+
+def internal_response(payload, status=200):
+    """Serializes an internal response in the format the client asked for (see above)."""
+    if request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        body, mimetype = msgpack.packb(payload), MSGPACK_MIMETYPE
+    else:
+        body, mimetype = orjson.dumps(payload), "application/json"
+    response = Response(body, status=status, mimetype=mimetype)
+    response.vary.add("Accept")
+    if INTERNAL_COMPRESS_MIN_BYTES:
+        response.vary.add("Accept-Encoding")
+        if len(body) >= INTERNAL_COMPRESS_MIN_BYTES and "gzip" in request.accept_encodings:
+            response.set_data(gzip.compress(body, INTERNAL_COMPRESS_LEVEL))
+            response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+MESSAGE_ROLES = ("system", "user", "assistant")
+
+
+def message_error(data):
+    """Why a message body can't be stored, or None; checked before it reaches the (possibly write-behind) insert."""
+    if data.get("role") not in MESSAGE_ROLES:
+        return f"role must be one of {', '.join(MESSAGE_ROLES)}"
+    if not isinstance(data.get("content"), str):
+        return "content must be a string"
+    if not isinstance(data.get("client_id"), (str, type(None))):
+        return "client_id must be a string"
+    return None
+
+
 # --- Public API Routes (for Frontend via Traefik) ---
 
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(token):
+    """Parses a cursor from encode_cursor; raises ValueError for anything but a (last_activity_at, id) pair."""
+    cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+    if not (isinstance(cursor, list) and len(cursor) == 2 and all(isinstance(part, str) for part in cursor)):
+        raise ValueError("cursor must be a pair of strings")
+    return tuple(cursor)
+
+
 @app.route("/api/sessions", methods=["GET"])
 def get_all_sessions():
-    return jsonify(db.get_all_sessions())
+    if 'cursor' not in request.args and 'limit' not in request.args:
+        return jsonify(db.get_all_sessions())
+
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    cursor = None
+    if request.args.get('cursor'):
+        try:
+            cursor = decode_cursor(request.args['cursor'])
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+    sessions, next_cursor = db.get_sessions_page(cursor, limit)
+    return jsonify({"sessions": sessions, "next_cursor": encode_cursor(next_cursor) if next_cursor else None})
+
+
+@app.route("/api/sessions/search", methods=["GET"])
+def search_sessions():
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "Search query not provided"}), 400
+    limit = max(1, min(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get("offset", 0, type=int))
+    results, has_more = db.search_messages(query, limit, offset)
+    return jsonify({"results": results, "next_offset": offset + limit if has_more else None})
 
 
 @app.route("/api/sessions/<session_id>", methods=["GET"])
 def get_session(session_id):
-    messages = db.get_session_messages(session_id)
-    if not messages:
-        return jsonify({"error": "Session not found"}), 404
-    info = db.get_session_info(session_id)
-    return jsonify({"messages": messages, "icon": info.get('icon'), "ai_name": info.get('ai_name')})
+    page_args = get_page_args()
+    if request.if_none_match:
+        # Revalidation only needs the revision counter, not the transcript.
+        revision = db.get_session_revision(session_id)
+        if revision is None:
+            return jsonify({"error": "Session not found"}), 404
+        etag = session_etag(session_id, revision, page_args)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+    if page_args is None:
+        session = db.get_session_with_messages(session_id)
+        if not session:
+            return jsonify({"error": "Session not found"}), 404
+        messages, next_before_id = session['messages'], None
+    else:
+        session = db.get_session_info(session_id)
+        if not session:
+            return jsonify({"error": "Session not found"}), 404
+        before_id, limit = page_args
+        messages, next_before_id = db.get_session_messages_page(session_id, before_id, limit)
+
+    response = jsonify({"messages": messages, "icon": session.get('icon'), "ai_name": session.get('ai_name'),
+                        "next_before_id": next_before_id})
+    response.set_etag(session_etag(session_id, session['revision'], page_args))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route("/api/sessions", methods=["POST"])
@@ -94,43 +272,122 @@ def handle_settings():
         db.save_settings_and_prompts(request.get_json())
         return jsonify({'message': 'Settings saved successfully!'})
     else:
-        settings = db.get_settings_and_prompts()
-        return jsonify(settings)
+        return settings_response()
 
 
 # --- Internal API Routes (for Chat Service, not exposed by Traefik) ---
 
 @app.route('/api/core/settings', methods=['GET'])
 def internal_settings():
-    settings = db.get_settings_and_prompts()
-    return jsonify(settings)
+    return settings_response()
 
 
 @app.route('/api/core/sessions/<session_id>/messages', methods=['GET', 'POST'])
 def internal_messages(session_id):
     if request.method == 'GET':
-        messages = db.get_session_messages(session_id)
-        return jsonify(messages)
+        if 'after_id' in request.args:
+            # Incremental sync: only the messages newer than after_id (or a full reset).
+            return internal_response(db.get_session_messages_since(
+                session_id, request.args.get('after_id', type=int), request.args.get('epoch', type=int)))
+        page_args = get_page_args()
+        if page_args is None:
+            return internal_response(db.get_session_messages(session_id))
+        before_id, limit = page_args
+        messages, next_before_id = db.get_session_messages_page(session_id, before_id, limit)
+        return internal_response({"messages": messages, "next_before_id": next_before_id})
     elif request.method == 'POST':
-        data = request.get_json()
-        role = data.get("role")
-        content = data.get("content")
-        db.add_message(session_id, role, content)
-        return jsonify({"success": True})
+        data = internal_request_data()
+        error = message_error(data)
+        if error:
+            return internal_response({"error": error}, 400)
+        db.add_message(session_id, data["role"], data["content"], data.get("stream_id"), data.get("client_id"))
+        return internal_response({"success": True})
+
+
+@app.route('/api/core/sessions/<session_id>/messages/append', methods=['POST'])
+def internal_append_and_fetch(session_id):
+    """
+    Appends a message and returns the updated history in one round trip. Clients
+    that send after_id/epoch only receive the messages newer than after_id. An
+    optional title is applied if this is the session's first message.
+    """
+    data = internal_request_data()
+    error = message_error(data)
+    if error:
+        return internal_response({"error": error}, 400)
+    history = db.add_message_and_fetch(session_id, data["role"], data["content"],
+                                       data.get("after_id"), data.get("epoch"), data.get("title"))
+    return internal_response(history)
+
+
+@app.route('/api/core/sessions/<session_id>/streams/<stream_id>', methods=['GET', 'PUT'])
+def internal_stream_checkpoint(session_id, stream_id):
+    """Partial text of a reply chat-service is streaming; replaced by the message once stored."""
+    if request.method == 'PUT':
+        content = internal_request_data().get("content")
+        if content is None:
+            return internal_response({"error": "content is required"}, 400)
+        db.save_stream_checkpoint(session_id, stream_id, content)
+        return internal_response({"success": True})
+    checkpoint = db.get_stream_checkpoint(session_id, stream_id)
+    if checkpoint is None:
+        return internal_response({"error": "Stream not found"}, 404)
+    return internal_response(checkpoint)
+
+
+@app.route('/api/core/sessions/<session_id>/summaries', methods=['POST'])
+def internal_add_summary(session_id):
+    data = internal_request_data()
+    if not data.get("content") or data.get("from_id") is None or data.get("to_id") is None:
+        return internal_response({"error": "content, from_id and to_id are required"}, 400)
+    db.add_summary(session_id, data["content"], data["from_id"], data["to_id"])
+    return internal_response({"success": True})
 
 
 @app.route('/api/core/sessions/<session_id>/rename', methods=['PUT'])
 def internal_rename(session_id):
-    data = request.get_json()
+    data = internal_request_data()
     title = data.get("title")
     db.rename_session(session_id, title)
-    return jsonify({"success": True})
+    return internal_response({"success": True})
 
 
 @app.route('/api/core/sessions/<session_id>/regenerate', methods=['POST'])
 def internal_regenerate(session_id):
     success = db.delete_last_assistant_message(session_id)
-    return jsonify({"success": success})
+    return internal_response({"success": success})
+
+
+@app.route('/api/core/sessions/<session_id>/regenerate/history', methods=['POST'])
+def internal_regenerate_and_fetch(session_id):
+    """Deletes the last assistant message and returns the remaining history in one round trip."""
+    success, history = db.delete_last_assistant_message_and_fetch(session_id)
+    return internal_response({"success": success, **history})
+
+
+@app.route('/api/core/archive', methods=['GET', 'POST'])
+def internal_archive():
+    if request.method == 'POST':
+        data = internal_request_data()
+        stats = db.archive_idle_sessions(data.get("idle_days", db.ARCHIVE_IDLE_DAYS), data.get("limit"))
+        return internal_response(stats)
+    return internal_response(db.get_archive_stats())
+
+
+# --- Maintenance Commands ---
+
+@app.cli.command("archive-sessions")
+@click.option("--idle-days", default=db.ARCHIVE_IDLE_DAYS, show_default=True,
+              help="Archive sessions with no activity for this many days.")
+@click.option("--limit", type=int, default=None, help="Maximum number of sessions to archive in this run.")
+def archive_sessions_command(idle_days, limit):
+    """Moves idle sessions into compressed cold storage."""
+    stats = db.archive_idle_sessions(idle_days, limit)
+    click.echo(f"Archived {stats['sessions_archived']} sessions: {stats['raw_bytes']} -> "
+               f"{stats['compressed_bytes']} bytes ({stats['bytes_saved']} saved).")
+    totals = db.get_archive_stats()
+    click.echo(f"Cold storage now holds {totals['archived_sessions']} sessions, "
+               f"{totals['bytes_saved']} bytes saved in total.")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,69 @@
+"""
+Latency of a chat turn's database work: reading a session's history and
+appending a message, from several threads at once, against database.py
+directly (no HTTP). Reproduces the numbers of the connection pooling change.
+
+    python bench/db_latency.py
+    python bench/db_latency.py --app /path/to/other/checkout/services/core-services/app
+
+The database is created in a temporary directory and removed afterwards.
+"""
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--app", default=APP_DIR, help="core-service app directory to import database.py from")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=300, help="read + append pairs per thread")
+    parser.add_argument("--history", type=int, default=200, help="messages in the session beforehand")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="core-bench-")
+    os.chdir(workdir)  # database.py uses a path relative to the working directory
+    os.makedirs("data")
+    sys.path.insert(0, os.path.abspath(args.app))
+    db = importlib.import_module("database")
+    try:
+        db.init_db()
+        db.create_session("bench", "New Chat", "You are a helpful assistant.")
+        for _ in range(args.history):
+            db.add_message("bench", "user", "hello world " * 20)
+
+        latencies = []
+
+        def worker():
+            for _ in range(args.turns):
+                start = time.perf_counter()
+                db.get_session_messages("bench")
+                db.add_message("bench", "user", "x" * 200)
+                latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        latencies.sort()
+        print(f"{args.threads} threads x {args.turns} turns, {args.history}-message session: "
+              f"p50 {percentile(latencies, 0.5) * 1000:.2f} ms  p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Cost of the internal wire format: fetching a whole session history
+(GET /api/core/sessions/<id>/messages?after_id=) from a running core-service
+as JSON and as MessagePack, decode included, for sessions of 10, 1k and 10k
+messages; and the serialization alone, in process, for jsonify, orjson and
+msgpack.
+
+    python bench/internal_wire.py                                # serialization only
+    python bench/internal_wire.py --core http://127.0.0.1:5000   # plus the HTTP round trips
+
+Start core-service with INTERNAL_COMPRESS_MIN_BYTES=1 to measure gzip as well.
+A core-service from before the wire format change answers JSON to every
+request, which the decoder below accepts.
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+import msgpack
+import orjson
+import requests
+from flask import Flask, jsonify
+
+SIZES = (10, 1000, 10000)
+WORDS = "the quick brown fox jumps over lazy dog lorem ipsum dolor sit amet python code".split()
+
+
+def message_text(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 200)))
+
+
+def decode(response):
+    if response.headers.get("Content-Type", "").startswith("application/msgpack"):
+        return msgpack.unpackb(response.content)
+    return orjson.loads(response.content)
+
+
+def median_ms(fn, repeats):
+    fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def serialization(messages):
+    app = Flask(__name__)
+    payload = {"messages": messages, "last_id": len(messages), "epoch": 0, "reset": True}
+    with app.app_context():
+        json_body = jsonify(payload).get_data()
+        print(f"serialization, {len(messages)} messages ({len(json_body) / 2 ** 20:.1f} MB of JSON):")
+        print(f"  encode: jsonify {median_ms(lambda: jsonify(payload).get_data(), 10):.1f} ms  "
+              f"orjson {median_ms(lambda: orjson.dumps(payload), 10):.1f} ms  "
+              f"msgpack {median_ms(lambda: msgpack.packb(payload), 10):.1f} ms")
+    packed = msgpack.packb(payload)
+    print(f"  decode: json.loads {median_ms(lambda: json.loads(json_body), 10):.1f} ms  "
+          f"orjson {median_ms(lambda: orjson.loads(json_body), 10):.1f} ms  "
+          f"msgpack {median_ms(lambda: msgpack.unpackb(packed), 10):.1f} ms  "
+          f"(msgpack body {len(packed) / len(json_body):.0%} of JSON)")
+
+
+def seed_session(core, count, rng):
+    session_id = requests.post(f"{core}/api/sessions", json={"prompt": "You are a helpful assistant."}).json()["id"]
+    texts = [message_text(rng) for _ in range(count)]
+
+    def post(i):
+        requests.post(f"{core}/api/core/sessions/{session_id}/messages",
+                    json={"role": "user" if i % 2 == 0 else "assistant", "content": texts[i]})
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(post, range(count)))
+    return session_id
+
+
+def round_trips(core):
+    rng = random.Random(1)
+    with requests.Session() as client:
+        for count in SIZES:
+            session_id = seed_session(core, count, rng)
+            url = f"{core}/api/core/sessions/{session_id}/messages"
+            print(f"--- {count} messages, median round trip including decode")
+            for label, headers in (("json", {"Accept": "application/json"}),
+                                   ("msgpack", {"Accept": "application/msgpack"}),
+                                   ("msgpack, gzip accepted", {"Accept": "application/msgpack", "Accept-Encoding": "gzip"})):
+                headers.setdefault("Accept-Encoding", "identity")
+                repeats = max(15, 5000 // count)
+                response = client.get(url, params={"after_id": ""}, headers=headers)
+                assert len(decode(response)["messages"]) >= count
+                ms = median_ms(lambda: decode(client.get(url, params={"after_id": ""}, headers=headers)), repeats)
+                wire_bytes = int(response.headers.get("Content-Length", len(response.content)))
+                print(f"  {label:24s} {ms:8.2f} ms  {response.headers.get('Content-Type', '').split(';')[0]:20s} "
+                      f"{wire_bytes} B on the wire ({response.headers.get('Content-Encoding', 'identity')})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--core", help="core-service base URL; without it only the serialization is measured")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    serialization([{"id": i, "role": "user" if i % 2 else "assistant", "content": message_text(rng),
+                    "timestamp": "2025-01-01 12:00:00"} for i in range(SIZES[-1])])
+    if args.core:
+        round_trips(args.core)
+
+
+if __name__ == "__main__":
+    main()
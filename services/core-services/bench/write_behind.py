@@ -0,0 +1,71 @@
+"""
+Insert throughput of add_message with and without the write-behind writer:
+many threads each appending to their own session, against database.py
+directly, with SQLITE_SYNCHRONOUS=FULL so every commit pays for an fsync.
+
+    python bench/write_behind.py direct    # one commit per add_message
+    python bench/write_behind.py commit    # MESSAGE_WRITE_BEHIND=1, WRITE_BEHIND_DURABILITY=commit
+    python bench/write_behind.py async     # MESSAGE_WRITE_BEHIND=1, WRITE_BEHIND_DURABILITY=async
+
+The database is created in a temporary directory and removed afterwards.
+"""
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("mode", choices=["direct", "commit", "async"])
+    parser.add_argument("--app", default=APP_DIR, help="core-service app directory to import database.py from")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--inserts", type=int, default=200, help="messages per thread")
+    args = parser.parse_args()
+
+    # database.py reads its settings at import time.
+    os.environ["MESSAGE_WRITE_BEHIND"] = "0" if args.mode == "direct" else "1"
+    os.environ["WRITE_BEHIND_DURABILITY"] = "commit" if args.mode == "direct" else args.mode
+    os.environ.setdefault("SQLITE_SYNCHRONOUS", "FULL")
+
+    workdir = tempfile.mkdtemp(prefix="core-bench-")
+    os.chdir(workdir)  # database.py uses a path relative to the working directory
+    os.makedirs("data")
+    sys.path.insert(0, os.path.abspath(args.app))
+    db = importlib.import_module("database")
+    try:
+        db.init_db()
+        for k in range(args.threads):
+            db.create_session(f"bench-{k}", "New Chat", "You are a helpful assistant.")
+
+        def worker(k):
+            for _ in range(args.inserts):
+                db.add_message(f"bench-{k}", "user", "x" * 300)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(k,)) for k in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if args.mode != "direct":
+            db.flush_message_writer()
+        elapsed = time.perf_counter() - start
+
+        # The system prompt plus every insert must have landed.
+        assert len(db.get_session_messages("bench-0")) == args.inserts + 1
+        total = args.threads * args.inserts
+        print(f"{args.mode}: {total} inserts from {args.threads} threads in {elapsed:.2f} s, "
+              f"{total / elapsed:.0f} inserts/s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
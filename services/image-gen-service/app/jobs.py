@@ -0,0 +1,244 @@
+# services/image-gen-service/app/jobs.py
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """Raised inside a running batch (from the step callback) once all of its jobs have been cancelled."""
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    """One image generation request and its progress, shared by the executor and HTTP threads."""
+
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = QUEUED
+        self.step = 0
+        self.total_steps = params.get("num_inference_steps")
+        self.error = None
+        self.result = None  # PNG bytes once succeeded
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = threading.Event()
+        # Bumped on every change, so event streams can wait for the next one.
+        self.version = 0
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def update(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def progress(self, step):
+        """Records a finished denoising step; a job cancelled while running is marked cancelled here."""
+        if self.cancel_requested.is_set():
+            if not self.finished:
+                self.update(status=CANCELLED, finished_at=time.time())
+            return
+        self.update(step=step)
+
+    def wait_for_change(self, version, timeout):
+        """Blocks until the job changes past `version` (or `timeout` passes) and returns the current version."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def report_progress(batch, step):
+    """Records a finished step for every job of a batch; raises JobCancelled once none of them is wanted."""
+    for job in batch:
+        job.progress(step)
+    if all(job.cancel_requested.is_set() for job in batch):
+        raise JobCancelled()
+
+
+class JobQueue:
+    """
+    A bounded queue of generation jobs worked off by a single executor thread.
+
+    The executor is the only thread that runs `run(batch)` (and so the pipeline);
+    HTTP handlers just submit, inspect and cancel jobs. The executor takes the
+    oldest waiting job plus up to `max_batch - 1` later ones with the same
+    `batch_key(params)`, waiting until the oldest has been queued for
+    `max_wait` seconds for the batch to fill up. `run` returns one result per
+    job. A queued job that is cancelled is dropped at once; a running one is
+    marked cancelled at its next step, and the batch stops when all of its
+    jobs are. Finished jobs, including their images, are kept for `retain_seconds`.
+    """
+
+    def __init__(self, run, max_size=16, retain_seconds=600, batch_key=None, max_batch=1, max_wait=0.0):
+        self.run = run
+        self.max_size = max_size
+        self.retain_seconds = retain_seconds
+        self.batch_key = batch_key or (lambda params: None)
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self._pending = deque()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._thread = None
+        self.batches = 0
+        self.batched_jobs = 0
+
+    def submit(self, params):
+        """Queues a job and returns it; raises QueueFull when max_size jobs are already waiting."""
+        self._ensure_executor()
+        job = Job(params)
+        with self._lock:
+            self._prune()
+            if len(self._pending) >= self.max_size:
+                raise QueueFull()
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._ready.notify()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job):
+        """Number of jobs ahead of `job`, counting the one running; None once it has started."""
+        if job.status != QUEUED:
+            return None
+        with self._lock:
+            return sum(1 for other in self._jobs.values()
+                       if other.created_at < job.created_at and not other.finished)
+
+    def cancel(self, job):
+        with self._lock:
+            job.cancel_requested.set()
+            if job.status == QUEUED:
+                # A job the executor has already taken for a batch is no longer pending;
+                # _next_batch drops it once it holds the lock again.
+                if job in self._pending:
+                    self._pending.remove(job)
+                job.update(status=CANCELLED, finished_at=time.time())
+
+    def _ensure_executor(self):
+        # Started on first use rather than at import, so it lives in the process that serves requests.
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._execute, name="image-gen-executor", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self):
+        with self._ready:
+            batch = []
+            while not batch:
+                self._ready.wait_for(lambda: self._pending)
+                first = self._pending.popleft()
+                batch = [first]
+                key = self.batch_key(first.params)
+                deadline = first.created_at + self.max_wait
+                while True:
+                    for job in list(self._pending):
+                        if len(batch) == self.max_batch:
+                            break
+                        if self.batch_key(job.params) == key:
+                            self._pending.remove(job)
+                            batch.append(job)
+                    remaining = deadline - time.time()
+                    if len(batch) == self.max_batch or remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                    # The lock was released: drop jobs cancelled meanwhile, starting over if none is left.
+                    batch = [job for job in batch if not job.finished]
+                    if not batch:
+                        break
+            # Marked under the lock, so cancel() sees a job either as queued (and dropped above) or running.
+            for job in batch:
+                job.update(status=RUNNING, started_at=time.time())
+            self.batches += 1
+            self.batched_jobs += len(batch)
+            return batch
+
+    def _execute(self):
+        while True:
+            self._run_batch(self._next_batch())
+            # Every waiting job moved up; wake their event streams.
+            with self._lock:
+                for job in self._pending:
+                    job.update()
+
+    def _run_batch(self, batch):
+        try:
+            results = self.run(batch)
+        except JobCancelled:
+            logger.info(f"Image batch of {len(batch)} cancelled at step {batch[0].step}/{batch[0].total_steps}.")
+            self._finish(batch, status=CANCELLED)
+        except Exception as e:
+            if len(batch) > 1:
+                # Run the jobs one by one, so a single bad request does not fail the others.
+                logger.warning(f"Image batch of {len(batch)} failed ({e}); retrying its jobs separately.")
+                for job in batch:
+                    if not job.finished:
+                        job.update(step=0)
+                        self._run_batch([job])
+                return
+            logger.error(f"Image job {batch[0].id} failed: {e}", exc_info=True)
+            self._finish(batch, status=FAILED, error=str(e))
+        else:
+            for job, result in zip(batch, results):
+                # Jobs cancelled mid-batch keep that status; their image is dropped.
+                self._finish([job], status=SUCCEEDED, result=result)
+
+    @staticmethod
+    def _finish(batch, **fields):
+        for job in batch:
+            if not job.finished:
+                job.update(finished_at=time.time(), **fields)
+
+    def _prune(self):
+        cutoff = time.time() - self.retain_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "max_queue": self.max_size,
+            "jobs": counts,
+            "batches": self.batches,
+            "mean_batch_size": round(self.batched_jobs / self.batches, 2) if self.batches else None,
+        }
@@ -1,11 +1,18 @@
 # services/image-gen-service/app/main.py
 import os
+import json
+import random
+import threading
 import torch
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, jsonify, abort
 from flask_cors import CORS
 from diffusers import StableDiffusionPipeline
 from io import BytesIO
 import logging
+from jobs import JobQueue, QueueFull, SUCCEEDED, report_progress
+from pipeline_cache import PipelineCache
+from model_store import ModelStore
+from prompt_cache import PromptEmbeddingCache
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO)
@@ -24,10 +31,46 @@ MODEL_PATH = os.path.join(CHECKPOINT_DIR, MODEL_FILENAME)
 PROMPT_PREFIX = ""
 API_PREFIX = "/api/image"
 
+# Generation runs as jobs on one executor thread: at most IMAGE_JOB_QUEUE_SIZE jobs
+# wait, and finished jobs (with their images) are kept for IMAGE_JOB_RETAIN_SECONDS.
+IMAGE_JOB_QUEUE_SIZE = int(os.environ.get("IMAGE_JOB_QUEUE_SIZE", "16"))
+IMAGE_JOB_RETAIN_SECONDS = int(os.environ.get("IMAGE_JOB_RETAIN_SECONDS", "600"))
+# Queued jobs with the same size, step count and guidance scale are run together as one
+# batched pipeline call of up to IMAGE_BATCH_MAX_SIZE images. An idle executor waits up
+# to IMAGE_BATCH_MAX_WAIT_MS after a job arrives for others to join it.
+IMAGE_BATCH_MAX_SIZE = int(os.environ.get("IMAGE_BATCH_MAX_SIZE", "4"))
+IMAGE_BATCH_MAX_WAIT_MS = int(os.environ.get("IMAGE_BATCH_MAX_WAIT_MS", "100"))
+# Seconds between messages on an idle progress stream, so proxies keep it open.
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+# Every open progress stream holds one of the worker's THREADS. At most
+# IMAGE_MAX_EVENT_STREAMS (by default half of them) are served at once, so threads stay
+# free to submit, poll and cancel jobs; further streams get a 503 and clients poll instead.
+IMAGE_MAX_EVENT_STREAMS = int(os.environ.get("IMAGE_MAX_EVENT_STREAMS",
+                                             str(max(1, int(os.environ.get("THREADS", "8")) // 2))))
+JOB_EVENTS_RETRY_AFTER_SECONDS = 5
+# Loaded checkpoints stay on the device, least recently used evicted first, while they
+# fit in IMAGE_PIPELINE_CACHE_GB; switching back to one of them skips from_single_file.
+IMAGE_PIPELINE_CACHE_GB = float(os.environ.get("IMAGE_PIPELINE_CACHE_GB", "6"))
+# Each checkpoint is converted once to diffusers format under IMAGE_CONVERTED_DIR, keyed
+# by its file hash; later loads memory-map the converted weights instead.
+IMAGE_CONVERTED_DIR = os.environ.get("IMAGE_CONVERTED_DIR", "./converted")
+# Requests outside these bounds are rejected when submitted rather than failing in the pipeline.
+# SD 1.5 needs sides that are multiples of 8.
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "2048"))
+IMAGE_MAX_STEPS = int(os.environ.get("IMAGE_MAX_STEPS", "150"))
+DEFAULT_NEGATIVE_PROMPT = "ugly, deformed, disfigured, poor quality, lowres, bad anatomy, extra limbs, blurry"
+# Text-encoder outputs of the last IMAGE_PROMPT_CACHE_SIZE (model, prompt) pairs are kept,
+# so repeated prompts and the default negative prompt are not encoded again.
+IMAGE_PROMPT_CACHE_SIZE = int(os.environ.get("IMAGE_PROMPT_CACHE_SIZE", "256"))
+
 # --- Global Model Pipeline and Status ---
-pipeline = None
-current_loaded_model_filename = None
+current_loaded_model_filename = None  # The model new jobs use unless they name another
 device = "cpu"  # Default to CPU, will be updated by get_device()
+model_store = None  # Created once the device (and so the dtype) is known
+pipeline_cache = None  # Created once the device is known, see the initialization below
+open_event_streams = 0
+event_streams_lock = threading.Lock()
+prompt_embeddings = PromptEmbeddingCache(IMAGE_PROMPT_CACHE_SIZE)  # Entries go with their model's pipeline
 
 
 def get_device():
@@ -44,25 +87,17 @@ def get_device():
 
 
 def unload_model():
-    """Unloads the current model from VRAM."""
-    global pipeline, current_loaded_model_filename
-    if pipeline is not None:
-        logger.info(f"Unloading model: {current_loaded_model_filename}")
-        del pipeline  # Delete the pipeline object
-        if device == "cuda":
-            # Important: Set pipeline to None BEFORE clearing cache to ensure
-            # no references are held, allowing VRAM to be freed.
-            pipeline = None
-            torch.cuda.empty_cache()  # Clear CUDA cache
-        else:
-            pipeline = None
-        current_loaded_model_filename = None
-        logger.info("Model unloaded successfully.")
+    """Unloads every cached model from VRAM."""
+    global current_loaded_model_filename
+    logger.info(f"Unloading models: {[entry['model'] for entry in pipeline_cache.stats()['resident']]}")
+    pipeline_cache.clear()
+    current_loaded_model_filename = None
+    logger.info("Models unloaded successfully.")
 
 
 def load_specific_model(model_filename: str):
-    """Loads a specific model by filename."""
-    global pipeline, current_loaded_model_filename
+    """Makes a model the current one, loading it into the pipeline cache unless it is resident."""
+    global current_loaded_model_filename
 
     model_path = os.path.join(CHECKPOINT_DIR, model_filename)
 
@@ -70,29 +105,18 @@ def load_specific_model(model_filename: str):
         logger.error(f"Model file not found: {model_path}")
         return False, f"Model file not found: {model_filename}"
 
-    if current_loaded_model_filename == model_filename and pipeline is not None:
+    cached = model_filename in pipeline_cache
+    if current_loaded_model_filename == model_filename and cached:
         logger.info(f"Model {model_filename} is already loaded.")
         return True, "Model already loaded."
 
-    # Unload any currently loaded model before loading a new one
-    if pipeline is not None:
-        unload_model()
-
     try:
-        logger.info(f"Attempting to load model from: {model_path}")
-        new_pipeline = StableDiffusionPipeline.from_single_file(
-            model_path,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-            use_safetensors=True
-        )
-        new_pipeline.to(device)
-        pipeline = new_pipeline
+        pipeline_cache.get(model_filename)
         current_loaded_model_filename = model_filename
-        logger.info(f"Model '{model_filename}' loaded successfully.")
-        return True, "Model loaded successfully."
+        logger.info(f"Model '{model_filename}' loaded successfully{' from the cache' if cached else ''}.")
+        return True, "Model loaded from cache." if cached else "Model loaded successfully."
     except Exception as e:
         logger.error(f"Failed to load model '{model_filename}': {e}", exc_info=True)
-        unload_model()  # Ensure VRAM is cleared on failure
         return False, f"Failed to load model: {str(e)}"
 
 
@@ -102,21 +126,21 @@ def health_check():
     """Health check endpoint to verify service and model status."""
     return jsonify({
         "status": "ok",
-        "model_loaded": pipeline is not None,
+        "model_loaded": current_loaded_model_filename is not None,
         "loaded_model_name": current_loaded_model_filename,
-        "device": device
+        "device": device,
+        "jobs": jobs.stats(),
+        "event_streams": {"open": open_event_streams, "max": IMAGE_MAX_EVENT_STREAMS},
+        "pipeline_cache": pipeline_cache.stats(),
+        "prompt_cache": prompt_embeddings.stats()
     })
 
 
 @app.route(f"{API_PREFIX}/models", methods=["GET"])
 def list_models():
-    """Returns a list of available model filenames."""
-    models = []
-    if os.path.exists(CHECKPOINT_DIR):
-        for f in os.listdir(CHECKPOINT_DIR):
-            if f.endswith((".safetensors", ".ckpt")):
-                models.append(f)
-    return jsonify({"models": sorted(models)})
+    """Returns the available model filenames, with their size, hash and conversion state in "details"."""
+    details = model_store.list_models()
+    return jsonify({"models": [model["filename"] for model in details], "details": details})
 
 
 @app.route(f"{API_PREFIX}/load", methods=["POST"])
@@ -136,73 +160,253 @@ def api_load_model():
 
 @app.route(f"{API_PREFIX}/unload", methods=["POST"])
 def api_unload_model():
-    """API endpoint to unload the current model."""
-    if pipeline is None:
+    """API endpoint to unload the current model, together with the rest of the pipeline cache."""
+    if current_loaded_model_filename is None and not pipeline_cache.stats()["resident"]:
         return jsonify({"status": "success", "message": "No model loaded to unload."})
 
     unload_model()
     return jsonify({"status": "success", "message": "Model unloaded."})
 
 
-@app.route(f"{API_PREFIX}/generate", methods=["POST"])
-def generate_image():
-    """Generates an image using the loaded SD 1.5 model."""
-    if pipeline is None:
-        return Response("Stable Diffusion 1.5 model is not currently loaded. Please load a model first.", status=503)
-
+@app.route(f"{API_PREFIX}/prefetch", methods=["POST"])
+def api_prefetch_model():
+    """Starts loading a model into the pipeline cache in the background, e.g. ahead of switching to it."""
     data = request.get_json()
-    if not data or "prompt" not in data:
-        return Response("Invalid request. 'prompt' is required.", status=400)
-
-    try:
-        prompt = data.get("prompt")
-        negative_prompt = data.get("negative_prompt",
-                                   "ugly, deformed, disfigured, poor quality, lowres, bad anatomy, extra limbs, blurry")
-        height = data.get("height", 512)
-        width = data.get("width", 512)
-        num_inference_steps = data.get("num_inference_steps", 25)
-        guidance_scale = data.get("guidance_scale", 7.0)
-
-        full_prompt = PROMPT_PREFIX + prompt
-
-        logger.info(f"Generating SD 1.5 image with '{current_loaded_model_filename}' for prompt: '{full_prompt}'")
-
-        image = pipeline(
-            prompt=full_prompt,
-            negative_prompt=negative_prompt,
-            height=height,
-            width=width,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale
-        ).images[0]
-
+    model_filename = data.get("model_filename")
+    if not model_filename:
+        return Response("Model filename not provided.", status=400)
+    if not os.path.exists(os.path.join(CHECKPOINT_DIR, model_filename)):
+        return jsonify({"status": "error", "message": f"Model file not found: {model_filename}"}), 404
+
+    started = pipeline_cache.prefetch(model_filename)
+    message = "Prefetch started." if started else "Model is already cached or loading."
+    return jsonify({"status": "success", "message": message}), 202
+
+
+def batch_key(params):
+    """Jobs can share a pipeline call when everything but the prompts and seed matches."""
+    return (params["model_filename"], params["height"], params["width"], params["num_inference_steps"],
+            params["guidance_scale"])
+
+
+def run_generation_batch(batch):
+    """
+    Runs a batch of compatible jobs as one pipeline call on the executor thread and
+    returns their images as PNG bytes, in order. Each image gets its own generator,
+    so its seed reproduces it whether or not it shared a batch (up to small
+    floating-point differences).
+    """
+    params = batch[0].params
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        # Raises JobCancelled once every job in the batch is cancelled, which ends the denoising loop.
+        report_progress(batch, step + 1)
+        return callback_kwargs
+
+    pipeline = pipeline_cache.get(params["model_filename"])
+    prompts = [PROMPT_PREFIX + job.params["prompt"] for job in batch]
+    logger.info(f"Generating {len(batch)} SD 1.5 image(s) with '{params['model_filename']}' for prompts: {prompts}")
+    # Prompts and negative prompts are looked up (and the missing ones encoded) together.
+    embeddings = prompt_embeddings.encode(params["model_filename"], pipeline,
+                                          prompts + [job.params["negative_prompt"] for job in batch])
+    images = pipeline(
+        prompt_embeds=embeddings[:len(batch)],
+        negative_prompt_embeds=embeddings[len(batch):],
+        height=params["height"],
+        width=params["width"],
+        num_inference_steps=params["num_inference_steps"],
+        guidance_scale=params["guidance_scale"],
+        generator=[torch.Generator(device).manual_seed(job.params["seed"]) for job in batch],
+        callback_on_step_end=on_step_end
+    ).images
+
+    results = []
+    for image in images:
         buffer = BytesIO()
         image.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        logger.info("Image generated successfully.")
+        results.append(buffer.getvalue())
+    logger.info(f"Batch of {len(batch)} image(s) generated successfully.")
+    return results
+
+
+jobs = JobQueue(run_generation_batch, IMAGE_JOB_QUEUE_SIZE, IMAGE_JOB_RETAIN_SECONDS,
+                batch_key, IMAGE_BATCH_MAX_SIZE, IMAGE_BATCH_MAX_WAIT_MS / 1000)
+
+
+def job_state(job):
+    return {**job.to_dict(), "seed": job.params["seed"], "position": jobs.position(job)}
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def job_params(data):
+    """
+    The generation parameters of a request body, with defaults filled in. Aborts
+    with 400 for a missing prompt or a value of the wrong type or out of range,
+    503 when no model is named or loaded and 404 for an unknown model file.
+    """
+    if not data or not isinstance(data.get("prompt"), str):
+        abort(Response("Invalid request. 'prompt' is required.", status=400))
+
+    params = {
+        "prompt": data["prompt"],
+        "negative_prompt": data.get("negative_prompt", DEFAULT_NEGATIVE_PROMPT),
+        "height": data.get("height", 512),
+        "width": data.get("width", 512),
+        "num_inference_steps": data.get("num_inference_steps", 25),
+        "guidance_scale": data.get("guidance_scale", 7.0),
+        "seed": data.get("seed"),
+        "model_filename": data.get("model_filename") or current_loaded_model_filename,
+    }
+    errors = []
+    if not isinstance(params["negative_prompt"], str):
+        errors.append("'negative_prompt' must be a string")
+    for side in ("height", "width"):
+        if not is_int(params[side]) or not 8 <= params[side] <= IMAGE_MAX_SIDE or params[side] % 8:
+            errors.append(f"'{side}' must be a multiple of 8 from 8 to {IMAGE_MAX_SIDE}")
+    if not is_int(params["num_inference_steps"]) or not 1 <= params["num_inference_steps"] <= IMAGE_MAX_STEPS:
+        errors.append(f"'num_inference_steps' must be an integer from 1 to {IMAGE_MAX_STEPS}")
+    if isinstance(params["guidance_scale"], bool) or not isinstance(params["guidance_scale"], (int, float)) \
+            or params["guidance_scale"] < 0:
+        errors.append("'guidance_scale' must be a non-negative number")
+    if params["seed"] is not None and (not is_int(params["seed"]) or not 0 <= params["seed"] < 2 ** 64):
+        errors.append("'seed' must be an integer from 0 to 2**64 - 1")
+    if not isinstance(params["model_filename"], (str, type(None))):
+        errors.append("'model_filename' must be a string")
+    if errors:
+        abort(Response(f"Invalid request: {'; '.join(errors)}.", status=400))
+
+    if params["model_filename"] is None:
+        abort(Response("Stable Diffusion 1.5 model is not currently loaded. Please load a model first.", status=503))
+    if not os.path.exists(os.path.join(CHECKPOINT_DIR, params["model_filename"])):
+        abort(Response(f"Model file not found: {params['model_filename']}", status=404))
+    if params["seed"] is None:
+        # Reported back with the job, so any image can be made again.
+        params["seed"] = random.randrange(2 ** 32)
+    return params
+
+
+def enqueue_job(params):
+    """Submits a job and starts loading its model if needed; aborts with 429 when the queue is full."""
+    try:
+        job = jobs.submit(params)
+    except QueueFull:
+        abort(Response("Too many images are queued. Please try again later.", status=429,
+                       headers={"Retry-After": "30"}))
+    pipeline_cache.prefetch(params["model_filename"])
+    return job
 
-        return Response(buffer.getvalue(), mimetype='image/png')
 
-    except Exception as e:
-        logger.error(f"An error occurred during image generation: {e}", exc_info=True)
-        return Response(f"Internal server error: {str(e)}", status=500)
+@app.route(f"{API_PREFIX}/generate", methods=["POST"])
+def generate_image():
+    """
+    Generates an image and returns the PNG once it is done, as before jobs existed.
+    Runs as a job like any other, so it waits its turn in the queue (and may share
+    a batch); this request's thread is held until the job has finished.
+    """
+    job = enqueue_job(job_params(request.get_json(silent=True)))
+    version = None
+    while not job.finished:
+        version = job.wait_for_change(version, JOB_EVENTS_KEEPALIVE_SECONDS)
+    if job.status != SUCCEEDED:
+        return Response(f"Internal server error: {job.error or job.status}", status=500)
+    return Response(job.result, mimetype='image/png')
+
+
+@app.route(f"{API_PREFIX}/jobs", methods=["POST"])
+def submit_job():
+    """
+    Queues an image generation and returns its job id at once. The job uses the
+    SD 1.5 model named by `model_filename`, or else the currently loaded one; a
+    model that is not cached starts loading in the background right away.
+    """
+    job = enqueue_job(job_params(request.get_json(silent=True)))
+    response = jsonify(job_state(job))
+    response.status_code = 202
+    response.headers["Location"] = f"{API_PREFIX}/jobs/{job.id}"
+    return response
+
+
+@app.route(f"{API_PREFIX}/jobs/<job_id>", methods=["GET", "DELETE"])
+def job_status(job_id):
+    """
+    GET returns the job's status and progress. DELETE cancels it: a queued job
+    never starts, a running one stops after its current denoising step.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return Response("Job not found.", status=404)
+    if request.method == "DELETE":
+        jobs.cancel(job)
+    return jsonify(job_state(job))
+
+
+@app.route(f"{API_PREFIX}/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    """The generated PNG; 409 with the job's status while it is not (or never will be) available."""
+    job = jobs.get(job_id)
+    if job is None:
+        return Response("Job not found.", status=404)
+    if job.result is None:
+        return jsonify(job_state(job)), 409
+    return Response(job.result, mimetype='image/png')
+
+
+@app.route(f"{API_PREFIX}/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    Server-sent events with the job's state on every change, ending once the job has
+    finished. Answers 503 while IMAGE_MAX_EVENT_STREAMS streams are open.
+    """
+    global open_event_streams
+    job = jobs.get(job_id)
+    if job is None:
+        return Response("Job not found.", status=404)
+    with event_streams_lock:
+        if open_event_streams >= IMAGE_MAX_EVENT_STREAMS:
+            return Response("Too many open progress streams; poll the job instead.", status=503,
+                            headers={"Retry-After": str(JOB_EVENTS_RETRY_AFTER_SECONDS)})
+        open_event_streams += 1
+
+    def close_stream():
+        global open_event_streams
+        with event_streams_lock:
+            open_event_streams -= 1
+
+    def generate():
+        version = None
+        while True:
+            current = job.wait_for_change(version, JOB_EVENTS_KEEPALIVE_SECONDS)
+            if current == version:
+                yield ": keepalive\n\n"
+                continue
+            version = current
+            yield f"data: {json.dumps(job_state(job))}\n\n"
+            if job.finished:
+                return
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Called by the server once the stream ends or the client has gone away.
+    response.call_on_close(close_stream)
+    return response
 
 
 # --- Model Loading and App Initialization Logic ---
 # This code block executes once when the Python module is loaded.
 # With Gunicorn --preload, this runs in the master process before workers are forked.
 get_device()  # Detect GPU presence
+model_store = ModelStore(StableDiffusionPipeline, CHECKPOINT_DIR, IMAGE_CONVERTED_DIR,
+                         torch.float16 if device == "cuda" else torch.float32)
+pipeline_cache = PipelineCache(model_store.load, device, int(IMAGE_PIPELINE_CACHE_GB * 1024 ** 3),
+                               model_store.component_digests, prompt_embeddings.invalidate)
 
 # Attempt to load a default model if any exist on startup
-available_models = []
-if os.path.exists(CHECKPOINT_DIR):
-    for f in os.listdir(CHECKPOINT_DIR):
-        if f.endswith((".safetensors", ".ckpt")):
-            available_models.append(f)
+available_models = [model["filename"] for model in model_store.list_models()]
 
 if available_models:
-    available_models.sort()
     success, msg = load_specific_model(available_models[0])
     if not success:
         logger.error(f"Failed to load default model on startup: {msg}")
@@ -0,0 +1,193 @@
+# services/image-gen-service/app/model_store.py
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from pipeline_cache import shared_component_digests
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_EXTENSIONS = (".safetensors", ".ckpt")
+INDEX_FILENAME = "index.json"
+# Written last, so a converted directory without it is an unfinished conversion.
+META_FILENAME = "meta.json"
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class ModelStore:
+    """
+    The checkpoints in `checkpoint_dir`, each converted once to a diffusers-format
+    directory under `converted_dir`.
+
+    A conversion is keyed by the SHA-256 of the checkpoint file and the dtype, so a
+    renamed checkpoint reuses it and a replaced one is converted again. File hashes
+    are remembered by filename, size and modification time in an index, which also
+    holds what `list_models` reports without reading the checkpoints. Loading a
+    converted directory memory-maps its safetensors weights and skips config
+    inference and key conversion. If a conversion cannot be written (e.g. the
+    directory is read-only), the checkpoint keeps being loaded from its single file.
+    """
+
+    def __init__(self, pipeline_class, checkpoint_dir, converted_dir, dtype):
+        self.pipeline_class = pipeline_class
+        self.checkpoint_dir = checkpoint_dir
+        self.converted_dir = converted_dir
+        self.dtype = dtype
+        self.dtype_name = str(dtype).removeprefix("torch.")
+        self._index_path = os.path.join(converted_dir, INDEX_FILENAME)
+        self._index = {}  # filename -> {"size", "mtime_ns", "sha256", conversion metadata once converted}
+        self._lock = threading.Lock()
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable model store index {self._index_path}: {e}")
+
+    def _save_index(self):
+        """Writes the index atomically; called with the lock held."""
+        try:
+            os.makedirs(self.converted_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.converted_dir, prefix=".index-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._index, f, indent=2, sort_keys=True)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logger.warning(f"Could not write the model store index {self._index_path}: {e}")
+
+    def _known_entry(self, filename, stat):
+        entry = self._index.get(filename)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry
+        return None
+
+    def _entry(self, filename):
+        """The index entry of a checkpoint, hashing the file if it is new or has changed."""
+        stat = os.stat(os.path.join(self.checkpoint_dir, filename))
+        with self._lock:
+            entry = self._known_entry(filename, stat)
+        if entry is not None:
+            return entry
+        started = time.perf_counter()
+        sha256 = file_sha256(os.path.join(self.checkpoint_dir, filename))
+        logger.info(f"Hashed '{filename}' ({stat.st_size / 1024 ** 3:.2f} GB) in {time.perf_counter() - started:.1f} s.")
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+        with self._lock:
+            self._index[filename] = entry
+            self._save_index()
+        return entry
+
+    def converted_path(self, entry):
+        return os.path.join(self.converted_dir, f"{entry['sha256']}-{self.dtype_name}")
+
+    def load(self, filename):
+        """Builds the pipeline of a checkpoint on the CPU, converting the checkpoint on first use."""
+        entry = self._entry(filename)
+        target = self.converted_path(entry)
+        started = time.perf_counter()
+        try:
+            with open(os.path.join(target, META_FILENAME)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = None
+        if meta is not None:
+            logger.info(f"Loading model '{filename}' from its converted copy {target}")
+            pipeline = self.pipeline_class.from_pretrained(
+                target,
+                torch_dtype=self.dtype,
+                use_safetensors=True,
+                local_files_only=True
+            )
+            logger.info(f"Loaded '{filename}' from its converted copy in {time.perf_counter() - started:.1f} s.")
+            with self._lock:
+                entry.update(converted=os.path.basename(target), component_digests=meta["component_digests"])
+            return pipeline
+
+        model_path = os.path.join(self.checkpoint_dir, filename)
+        logger.info(f"Attempting to load model from: {model_path}")
+        pipeline = self.pipeline_class.from_single_file(
+            model_path,
+            torch_dtype=self.dtype,
+            use_safetensors=True
+        )
+        logger.info(f"Loaded '{filename}' from its single file in {time.perf_counter() - started:.1f} s.")
+        self._convert(filename, entry, pipeline, target)
+        return pipeline
+
+    def _convert(self, filename, entry, pipeline, target):
+        started = time.perf_counter()
+        digests = shared_component_digests(pipeline)
+        with self._lock:
+            entry["component_digests"] = digests
+        tmp_dir = None
+        try:
+            os.makedirs(self.converted_dir, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=self.converted_dir, prefix=".converting-")
+            os.chmod(tmp_dir, 0o755)
+            pipeline.save_pretrained(tmp_dir, safe_serialization=True)
+            with open(os.path.join(tmp_dir, META_FILENAME), "w") as f:
+                json.dump({
+                    "filename": filename,
+                    "size": entry["size"],
+                    "sha256": entry["sha256"],
+                    "dtype": self.dtype_name,
+                    "component_digests": digests,
+                    "converted_at": time.time(),
+                }, f, indent=2)
+            try:
+                os.rename(tmp_dir, target)
+            except OSError:
+                # Converted in the meantime under another name of the same file; keep that copy.
+                if not os.path.exists(os.path.join(target, META_FILENAME)):
+                    raise
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            tmp_dir = None
+        except Exception as e:
+            logger.warning(f"Could not convert '{filename}' into {self.converted_dir}; "
+                           f"it will be loaded from its single file again: {e}")
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        logger.info(f"Converted '{filename}' to {target} in {time.perf_counter() - started:.1f} s.")
+        with self._lock:
+            entry["converted"] = os.path.basename(target)
+            self._save_index()
+
+    def component_digests(self, filename, pipeline):
+        """The shared-component digests of a pipeline from `load`, read from the index when known."""
+        with self._lock:
+            digests = self._index.get(filename, {}).get("component_digests")
+        return digests if digests is not None else shared_component_digests(pipeline)
+
+    def list_models(self):
+        """
+        The checkpoints with what the index knows about them. Files that are new or
+        have changed since they were last loaded are listed without a hash.
+        """
+        models = []
+        if not os.path.exists(self.checkpoint_dir):
+            return models
+        for filename in sorted(os.listdir(self.checkpoint_dir)):
+            if not filename.endswith(CHECKPOINT_EXTENSIONS):
+                continue
+            stat = os.stat(os.path.join(self.checkpoint_dir, filename))
+            with self._lock:
+                entry = self._known_entry(filename, stat) or {}
+            converted = entry.get("converted")
+            models.append({
+                "filename": filename,
+                "size_bytes": stat.st_size,
+                "sha256": entry.get("sha256"),
+                "converted": bool(converted) and os.path.exists(os.path.join(self.converted_dir, converted, META_FILENAME)),
+            })
+        return models
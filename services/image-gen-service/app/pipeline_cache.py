@@ -0,0 +1,218 @@
+# services/image-gen-service/app/pipeline_cache.py
+import json
+import hashlib
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Components that SD 1.5 checkpoints often have in common; the UNet is what sets them apart.
+SHARED_COMPONENTS = ("vae", "text_encoder", "tokenizer", "safety_checker")
+
+
+def component_digest(component):
+    """Hashes a component's weights (or a tokenizer's vocabulary), so equal components can be shared."""
+    digest = hashlib.blake2b(type(component).__name__.encode(), digest_size=16)
+    if isinstance(component, torch.nn.Module):
+        for name, tensor in component.state_dict().items():
+            digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+            digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    else:
+        digest.update(json.dumps(component.get_vocab(), sort_keys=True).encode())
+        digest.update(repr(sorted(getattr(component, "bpe_ranks", {}).items(), key=lambda item: item[1])).encode())
+    return digest.hexdigest()
+
+
+def shared_component_digests(pipeline):
+    return {name: component_digest(getattr(pipeline, name)) for name in SHARED_COMPONENTS
+            if getattr(pipeline, name, None) is not None}
+
+
+def module_bytes(module):
+    return sum(tensor.numel() * tensor.element_size()
+               for tensor in itertools.chain(module.parameters(), module.buffers()))
+
+
+def pipeline_modules(pipeline):
+    return [component for component in pipeline.components.values() if isinstance(component, torch.nn.Module)]
+
+
+class PipelineCache:
+    """
+    Loaded pipelines by checkpoint filename, kept on `device` within `max_bytes`.
+
+    `load(filename)` builds a pipeline on the CPU; `digests(filename, pipeline)`
+    may supply its component digests when they are known already (by default
+    they are computed). Before the pipeline is moved to the device, each of its
+    SHARED_COMPONENTS whose weights hash equal to one that is already resident is
+    replaced by that one, so checkpoints with the same VAE or text encoder hold it
+    only once. Then least recently used pipelines are evicted until the new one
+    fits. A pipeline evicted while a job still uses it is freed once the job drops
+    it; `on_evict(filename)` is called (with the cache locked) so anything derived
+    from it can be dropped too. `prefetch` loads in a background thread;
+    concurrent requests for a model that is loading wait for that load.
+    """
+
+    def __init__(self, load, device, max_bytes, digests=None, on_evict=None):
+        self.load = load
+        self.digests = digests or (lambda filename, pipeline: shared_component_digests(pipeline))
+        self.on_evict = on_evict or (lambda filename: None)
+        self.device = device
+        self.max_bytes = max_bytes
+        self._pipelines = OrderedDict()  # filename -> pipeline, least recently used first
+        self._shared = {}  # digest -> [component, number of resident pipelines using it]
+        self._digests = {}  # filename -> digests of its shared components
+        self._loading = {}  # filename -> Event set when its load has ended
+        self._incoming = {}  # filename -> pipeline being moved to the device, already budgeted for
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.evictions = 0
+        self.shared_loads = 0
+
+    def __contains__(self, filename):
+        with self._lock:
+            return filename in self._pipelines
+
+    def get(self, filename):
+        """Returns the pipeline for `filename`, loading it first if it is not resident."""
+        with self._lock:
+            pipeline = self._pipelines.get(filename)
+            if pipeline is not None:
+                self._pipelines.move_to_end(filename)
+                self.hits += 1
+                return pipeline
+            self.misses += 1
+        return self._load(filename)
+
+    def prefetch(self, filename):
+        """Starts loading `filename` in the background unless it is resident or loading; returns whether it did."""
+        with self._lock:
+            if filename in self._pipelines or filename in self._loading:
+                return False
+            self.prefetches += 1
+        threading.Thread(target=self._prefetch, args=(filename,), name=f"prefetch-{filename}", daemon=True).start()
+        return True
+
+    def _prefetch(self, filename):
+        try:
+            self._load(filename)
+        except Exception as e:
+            logger.error(f"Failed to prefetch model '{filename}': {e}", exc_info=True)
+
+    def _load(self, filename):
+        while True:
+            with self._lock:
+                pipeline = self._pipelines.get(filename)
+                if pipeline is not None:
+                    self._pipelines.move_to_end(filename)
+                    return pipeline
+                loading = self._loading.get(filename)
+                if loading is None:
+                    self._loading[filename] = threading.Event()
+                    break
+            # Another thread is loading it; if that load fails, the next pass tries again.
+            loading.wait()
+
+        try:
+            logger.info(f"Loading model '{filename}' into the pipeline cache.")
+            pipeline = self.load(filename)
+            digests = self.digests(filename, pipeline)
+            with self._lock:
+                for name, digest in digests.items():
+                    entry = self._shared.get(digest)
+                    if entry is None:
+                        self._shared[digest] = [getattr(pipeline, name), 1]
+                    else:
+                        pipeline.register_modules(**{name: entry[0]})
+                        entry[1] += 1
+                        self.shared_loads += 1
+                        logger.info(f"Model '{filename}' shares its {name} with a resident model.")
+                self._digests[filename] = digests
+                self._make_room(pipeline)
+                self._incoming[filename] = pipeline
+            pipeline.to(self.device)
+            with self._lock:
+                self._pipelines[filename] = pipeline
+            return pipeline
+        except Exception:
+            with self._lock:
+                self._release(filename)
+            raise
+        finally:
+            with self._lock:
+                self._incoming.pop(filename, None)
+                self._loading.pop(filename).set()
+
+    def _resident_modules(self):
+        modules = {}
+        for pipeline in itertools.chain(self._pipelines.values(), self._incoming.values()):
+            for module in pipeline_modules(pipeline):
+                modules[id(module)] = module
+        return modules
+
+    def _make_room(self, pipeline):
+        """Evicts least recently used pipelines until `pipeline`'s components not yet resident fit."""
+        resident = self._resident_modules()
+        incoming = sum(module_bytes(module) for module in pipeline_modules(pipeline) if id(module) not in resident)
+        while self._pipelines and sum(map(module_bytes, resident.values())) + incoming > self.max_bytes:
+            self._evict(next(iter(self._pipelines)))
+            resident = self._resident_modules()
+            incoming = sum(module_bytes(module) for module in pipeline_modules(pipeline)
+                           if id(module) not in resident)
+        if incoming > self.max_bytes:
+            logger.warning(f"A single model needs {incoming / 1024 ** 3:.2f} GB, more than the "
+                           f"{self.max_bytes / 1024 ** 3:.2f} GB pipeline cache budget.")
+
+    def _evict(self, filename):
+        logger.info(f"Evicting model '{filename}' from the pipeline cache.")
+        del self._pipelines[filename]
+        self._release(filename)
+        self.evictions += 1
+        self.on_evict(filename)
+
+    def _release(self, filename):
+        for digest in self._digests.pop(filename, {}).values():
+            entry = self._shared[digest]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._shared[digest]
+
+    def evict(self, filename):
+        with self._lock:
+            if filename in self._pipelines:
+                self._evict(filename)
+        self._free_device_memory()
+
+    def clear(self):
+        with self._lock:
+            for filename in list(self._pipelines):
+                self._evict(filename)
+        self._free_device_memory()
+
+    def _free_device_memory(self):
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        with self._lock:
+            resident = [{"model": filename, "bytes": sum(map(module_bytes, pipeline_modules(pipeline)))}
+                        for filename, pipeline in reversed(self._pipelines.items())]
+            lookups = self.hits + self.misses
+            return {
+                "resident": resident,  # most recently used first
+                "loading": list(self._loading),
+                "resident_bytes": sum(map(module_bytes, self._resident_modules().values())),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "prefetches": self.prefetches,
+                "evictions": self.evictions,
+                "shared_components": sum(1 for _, users in self._shared.values() if users > 1),
+                "shared_loads": self.shared_loads,
+            }
@@ -0,0 +1,71 @@
+# services/image-gen-service/app/prompt_cache.py
+import logging
+import threading
+from collections import OrderedDict
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class PromptEmbeddingCache:
+    """
+    Text-encoder outputs by (model filename, text), the least recently used of
+    `max_entries` dropped first.
+
+    Prompts and negative prompts are tokenized and encoded the same way, so each
+    text is cached on its own and the default negative prompt is encoded once per
+    model. The cached embeddings live on the pipeline's device. A model's entries
+    are dropped with `invalidate` when its pipeline leaves the pipeline cache.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._embeddings = OrderedDict()  # (model filename, text) -> embedding, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def encode(self, model_filename, pipeline, texts):
+        """Returns the embeddings of `texts` as one batch, encoding only the ones not cached."""
+        found = {}
+        with self._lock:
+            for text in texts:
+                embedding = self._embeddings.get((model_filename, text))
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    self._embeddings.move_to_end((model_filename, text))
+                    self.hits += 1
+                    found[text] = embedding
+        missing = list(dict.fromkeys(text for text in texts if text not in found))
+        if missing:
+            with torch.no_grad():
+                encoded, _ = pipeline.encode_prompt(missing, pipeline._execution_device, 1, False)
+            found.update(zip(missing, encoded))
+            with self._lock:
+                for text in missing:
+                    self._embeddings[(model_filename, text)] = found[text]
+                    self._embeddings.move_to_end((model_filename, text))
+                while len(self._embeddings) > self.max_entries:
+                    self._embeddings.popitem(last=False)
+        return torch.stack([found[text] for text in texts])
+
+    def invalidate(self, model_filename=None):
+        """Drops the entries of one model, or of all models."""
+        with self._lock:
+            for key in [key for key in self._embeddings if model_filename in (None, key[0])]:
+                del self._embeddings[key]
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._embeddings),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "invalidations": self.invalidations,
+            }
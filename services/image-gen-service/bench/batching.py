@@ -0,0 +1,99 @@
+"""
+Throughput and latency of the job queue at several batch sizes, running the
+service's own run_generation_batch on a tiny random pipeline (see
+fixtures.py), for a burst of jobs and for jobs arriving at random.
+
+    python bench/batching.py --size 32
+    python bench/batching.py --size 64 --threads 1
+
+Also checks that a seed gives the same image alone and inside a batch.
+"""
+import argparse
+import io
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, "app"))
+sys.path.insert(0, BENCH_DIR)
+warnings.filterwarnings("ignore")
+os.chdir(tempfile.mkdtemp(prefix="image-bench-"))  # the service looks for ./checkpoints and finds none
+
+import torch
+from PIL import Image, ImageChops
+import main as service
+from fixtures import tiny_pipeline
+from jobs import JobQueue
+from pipeline_cache import PipelineCache
+
+MODEL = "tiny"
+# (max batch size, max wait in seconds) pairs to compare; the first one is no batching.
+SETTINGS = [(1, 0.0), (2, 0.1), (4, 0.1), (8, 0.1), (4, 0.5)]
+
+
+def job_params(i, size, steps, seed=None):
+    return {"prompt": f"a photo of thing {i}", "negative_prompt": "blurry", "model_filename": MODEL,
+            "height": size, "width": size, "num_inference_steps": steps, "guidance_scale": 7.0,
+            "seed": i if seed is None else seed}
+
+
+def wait(jobs):
+    while not all(job.finished for job in jobs):
+        time.sleep(0.01)
+
+
+def run(max_batch, max_wait, count, mean_gap, size, steps):
+    queue = JobQueue(service.run_generation_batch, 256, 600, service.batch_key, max_batch, max_wait)
+    jobs = []
+    for i in range(count):
+        jobs.append(queue.submit(job_params(i, size, steps)))
+        if mean_gap:
+            time.sleep(random.expovariate(1 / mean_gap))
+    wait(jobs)
+    latencies = sorted(job.finished_at - job.created_at for job in jobs)
+    span = max(job.finished_at for job in jobs) - min(job.created_at for job in jobs)
+    return (count / span, statistics.median(latencies), latencies[int(0.95 * (count - 1))],
+            queue.stats()["mean_batch_size"])
+
+
+def check_seed(size, steps):
+    alone = JobQueue(service.run_generation_batch, 8, 600, service.batch_key, 1, 0.0)
+    single = alone.submit(job_params(99, size, steps, seed=42))
+    batched = JobQueue(service.run_generation_batch, 8, 600, service.batch_key, 4, 0.5)
+    batch = [batched.submit(job_params(i, size, steps, seed=42 if i == 1 else None)) for i in range(4)]
+    wait([single] + batch)
+    diff = ImageChops.difference(Image.open(io.BytesIO(single.result)), Image.open(io.BytesIO(batch[1].result)))
+    print(f"seed 42 alone vs. in a batch of 4: max channel difference {max(hi for lo, hi in diff.getextrema())}/255")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=32, help="image width and height")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--threads", type=int, help="torch CPU threads")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    service.pipeline_cache = PipelineCache(lambda filename: tiny_pipeline(args.size), "cpu", 2 ** 30)
+    run(1, 0.0, 2, 0, args.size, args.steps)  # warm up
+    check_seed(args.size, args.steps)
+
+    for label, count, mean_gap in (("burst of 16", 16, 0), ("Poisson arrivals, mean gap 0.25 s", 24, 0.25)):
+        print(f"--- {label}, {args.size}x{args.size}, {args.steps} steps, {torch.get_num_threads()} CPU thread(s)")
+        for max_batch, max_wait in SETTINGS:
+            random.seed(1)
+            throughput, p50, p95, mean_batch = run(max_batch, max_wait, count, mean_gap, args.size, args.steps)
+            print(f"  max_batch={max_batch} max_wait={int(max_wait * 1000):3d} ms: {throughput:5.2f} img/s  "
+                  f"p50 {p50:5.2f} s  p95 {p95:5.2f} s  mean batch {mean_batch}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Load time and peak memory of one checkpoint, one way per run (run each in a
+fresh process so the peak RSS is its own):
+
+    python bench/model_loading.py checkpoints/model.safetensors single-file   # from_single_file, as before the model store
+    python bench/model_loading.py checkpoints/model.safetensors cold          # ModelStore: hash + load + convert
+    python bench/model_loading.py checkpoints/model.safetensors warm          # ModelStore: converted directory, memory-mapped
+
+Any SD 1.5 checkpoint works. "cold" first removes the store in
+--converted-dir. Without Hub access, pass --config with a local copy of the
+SD 1.5 diffusers configs (a directory from save_pretrained, weights optional).
+--drop-caches empties the page cache first (root only), as after a reboot.
+"""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app"))
+warnings.filterwarnings("ignore")
+
+import torch
+from diffusers import StableDiffusionPipeline
+from diffusers.utils import logging as diffusers_logging
+from model_store import ModelStore
+
+
+def offline_pipeline_class(config):
+    """StableDiffusionPipeline with from_single_file reading its configs from `config` instead of the Hub."""
+    class OfflinePipeline(StableDiffusionPipeline):
+        @classmethod
+        def from_single_file(cls, path, **kwargs):
+            return StableDiffusionPipeline.from_single_file(path, config=config, local_files_only=True, **kwargs)
+    return OfflinePipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("checkpoint", help=".safetensors or .ckpt file")
+    parser.add_argument("mode", choices=["single-file", "cold", "warm"])
+    parser.add_argument("--converted-dir", default="bench-converted", help="model store directory for cold and warm")
+    parser.add_argument("--config", help="local SD 1.5 diffusers config directory, for running without the Hub")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--drop-caches", action="store_true")
+    args = parser.parse_args()
+
+    diffusers_logging.disable_progress_bar()
+    diffusers_logging.set_verbosity_error()
+    pipeline_class = offline_pipeline_class(args.config) if args.config else StableDiffusionPipeline
+    dtype = getattr(torch, args.dtype)
+    checkpoint_dir, filename = os.path.split(os.path.abspath(args.checkpoint))
+    if args.mode == "cold":
+        shutil.rmtree(args.converted_dir, ignore_errors=True)
+    if args.drop_caches:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+
+    start = time.perf_counter()
+    if args.mode == "single-file":
+        pipeline = pipeline_class.from_single_file(args.checkpoint, torch_dtype=dtype, use_safetensors=True)
+    else:
+        pipeline = ModelStore(pipeline_class, checkpoint_dir, args.converted_dir, dtype).load(filename)
+    loaded = time.perf_counter() - start
+    # What moving the pipeline to the device does on a CPU: every weight gets read into memory.
+    for module in (pipeline.unet, pipeline.vae, pipeline.text_encoder):
+        for parameter in module.parameters():
+            parameter.data = parameter.data.clone()
+    resident = time.perf_counter() - start
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2  # KiB on Linux
+    print(f"{args.mode} {filename}: {loaded:.2f} s load, {resident:.2f} s resident, peak RSS {peak_rss:.2f} GB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Text encoding time per generation with and without PromptEmbeddingCache, on
+a tiny random pipeline carrying a full-size SD 1.5 text encoder (see
+fixtures.py), for batches of 1 and 4 new prompts:
+
+- before: every prompt and negative prompt encoded, as the pipeline does
+  when given prompt/negative_prompt
+- negative cached: new prompts, the negative prompt already cached
+- all cached: every text already cached
+
+    python bench/prompt_encoding.py
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import warnings
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, "app"))
+sys.path.insert(0, BENCH_DIR)
+warnings.filterwarnings("ignore")
+
+import torch
+from fixtures import tiny_pipeline, sd15_text_encoder
+from prompt_cache import PromptEmbeddingCache
+
+NEGATIVE_PROMPT = "blurry, low quality, bad anatomy, deformed"
+
+
+def median_ms(fn, repeats):
+    fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, help="torch CPU threads")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    pipeline = tiny_pipeline()
+    pipeline.register_modules(text_encoder=sd15_text_encoder())
+
+    for batch_size in (1, 4):
+        prompts = [f"a photo of a cat number {i}" for i in range(batch_size)]
+        texts = prompts + [NEGATIVE_PROMPT] * batch_size
+
+        def before():
+            with torch.no_grad():
+                pipeline.encode_prompt(prompts, "cpu", 1, True, [NEGATIVE_PROMPT] * batch_size)
+
+        def negative_cached():
+            cache = PromptEmbeddingCache(256)
+            cache.encode("model", pipeline, [NEGATIVE_PROMPT])
+            start = time.perf_counter()
+            cache.encode("model", pipeline, texts)
+            return (time.perf_counter() - start) * 1000
+
+        warm = PromptEmbeddingCache(256)
+        warm.encode("model", pipeline, texts)
+        negative_cached_ms = statistics.median(negative_cached() for _ in range(max(5, args.repeats // 2)))
+        print(f"batch {batch_size}: before {median_ms(before, args.repeats):8.2f} ms  "
+              f"negative cached {negative_cached_ms:8.2f} ms  "
+              f"all cached {median_ms(lambda: warm.encode('model', pipeline, texts), args.repeats):6.2f} ms")
+
+    entry = warm.encode("model", pipeline, [NEGATIVE_PROMPT])[0]
+    print(f"one entry: {tuple(entry.shape)} {str(entry.dtype).replace('torch.', '')}, "
+          f"{entry.numel() * entry.element_size() // 1024} KB")
+
+
+if __name__ == "__main__":
+    main()
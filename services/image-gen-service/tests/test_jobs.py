@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app"))
+
+from jobs import CANCELLED, SUCCEEDED, JobQueue
+
+
+class RecordingRun:
+    """A `run` for JobQueue that records the ids of every batch it is given."""
+
+    def __init__(self):
+        self.batches = []
+        self.ran = threading.Event()
+
+    def __call__(self, batch):
+        self.batches.append([job.id for job in batch])
+        self.ran.set()
+        return [b"png"] * len(batch)
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+class CancelWhileBatchingTest(unittest.TestCase):
+    """Jobs the executor has taken from the queue but not started while it waits out max_wait."""
+
+    def setUp(self):
+        self.run = RecordingRun()
+        self.jobs = JobQueue(self.run, max_batch=4, max_wait=0.5)
+
+    def wait_until_claimed(self, job):
+        wait_until(lambda: job not in self.jobs._pending)
+
+    def test_cancel_only_job_of_forming_batch(self):
+        job = self.jobs.submit({"num_inference_steps": 1})
+        self.wait_until_claimed(job)
+
+        self.jobs.cancel(job)
+        self.assertEqual(job.status, CANCELLED)
+
+        later = self.jobs.submit({"num_inference_steps": 1})
+        wait_until(lambda: later.finished)
+        self.assertEqual(later.status, SUCCEEDED)
+        self.assertEqual(job.status, CANCELLED)
+        self.assertEqual(self.run.batches, [[later.id]])
+
+    def test_cancel_one_job_of_forming_batch(self):
+        first = self.jobs.submit({"num_inference_steps": 1})
+        self.wait_until_claimed(first)
+        second = self.jobs.submit({"num_inference_steps": 1})
+        self.wait_until_claimed(second)
+
+        self.jobs.cancel(second)
+
+        wait_until(lambda: first.finished)
+        self.assertEqual(first.status, SUCCEEDED)
+        self.assertEqual(second.status, CANCELLED)
+        self.assertEqual(self.run.batches, [[first.id]])
+
+
+if __name__ == "__main__":
+    unittest.main()